@@ -1,7 +1,8 @@
 from pathlib import Path
 import streamlit as st
 import time
-from datetime import datetime
+import uuid
+from workspace import Workspace, cleanup_workspaces
 
 st.set_page_config(page_title="HVDC Foundation Setting Out Automation", layout="wide")
 st.title("HVDC Foundation Setting Out Automattion")
@@ -10,13 +11,51 @@ st.subheader("Please upload required files below!")
 # Save location (absolute, next to this script)
 script_dir = Path(__file__).resolve().parent
 UPLOAD_DIR = script_dir / "uploads"
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Runs executed at the same time, each one in its own workspace folder
+MAX_CONCURRENT_RUNS = 2
+# Finished workspaces kept on disk
+KEEP_WORKSPACES = 20
+# Session upload folders kept on disk (each run copies the uploads into its workspace)
+KEEP_UPLOADS = 20
+# Stage/DXF cache size limit (least recently used entries are deleted beyond it)
+CACHE_MAX_GB = 20
+# Load the pipeline modules (ezdxf, shapely, matplotlib...) when the app starts instead of on the first run
+PREWARM_PIPELINE = True
+# Run log panel level: INFO shows the stage steps and summaries, DEBUG also per item details (slower on big drawings)
+LOG_LEVEL = "INFO"
+
+# Pipeline jobs run on background threads shared by all sessions
+@st.cache_resource
+def get_job_runner():
+    from jobs import JobRunner
+    import runlog
+    runlog.set_level(LOG_LEVEL)
+    return JobRunner(max_workers=MAX_CONCURRENT_RUNS, prewarm=PREWARM_PIPELINE)
+
+job_runner = get_job_runner()
 
 # Session state defaults
 if "automation_status" not in st.session_state:
     st.session_state["automation_status"] = "idle"  # idle | running | completed
 if "automation_completed_at" not in st.session_state:
     st.session_state["automation_completed_at"] = None
+if "output_profile" not in st.session_state:
+    st.session_state["output_profile"] = "lean"  # lean | debug (pipeline.OUTPUT_PROFILES)
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex[:12]
+
+# Uploads are kept per browser session so users don't overwrite each other's files
+session_upload_dir = UPLOAD_DIR / st.session_state["session_id"]
+session_upload_dir.mkdir(parents=True, exist_ok=True)
+
+# Reattach to a job after a page refresh / browser reconnect (job id kept in the URL)
+if "job_id" not in st.session_state and "job" in st.query_params:
+    job = job_runner.get(st.query_params["job"])
+    if job is not None:
+        st.session_state["job_id"] = job.id
+        st.session_state["automation_status"] = "completed" if job.done else "running"
+        if job.finished_at:
+            st.session_state["automation_completed_at"] = job.finished_at.strftime("%Y-%m-%d %H:%M:%S")
 
 # Reusable uploader
 def labelled_uploader(label, file_types, key):
@@ -32,7 +71,7 @@ def labelled_uploader(label, file_types, key):
             label_visibility="collapsed"
         )
     if file:
-        save_path = UPLOAD_DIR / file.name
+        save_path = session_upload_dir / file.name
         save_path.write_bytes(file.getbuffer())
         st.session_state[f"{key}_saved_path"] = str(save_path)
         st.success(f"Uploaded: {file.name}\nSaved to: {save_path}")
@@ -52,7 +91,9 @@ required = {
     "found_type_sheet": "Design Foundations Type",
     "boq_sheet": "BoQ Spreadsheet",
 }
-missing = [label for k, label in required.items() if f"{k}_saved_path" not in st.session_state]
+# an upload folder deleted by the retention below counts as missing
+missing = [label for k, label in required.items()
+           if not Path(st.session_state.get(f"{k}_saved_path", "")).is_file()]
 ready = len(missing) == 0
 
 if st.session_state["automation_status"] == "idle":
@@ -61,6 +102,22 @@ if st.session_state["automation_status"] == "idle":
     else:
         st.success("All required files uploaded.")
 
+    # lean: deliverables only, debug: also the per stage DXF/XLSX diagnostics in shared/
+    output_profile = st.radio(
+        "Output files",
+        ["lean", "debug"],
+        index=["lean", "debug"].index(st.session_state["output_profile"]),
+        format_func={"lean": "Deliverables only", "debug": "Deliverables + per stage diagnostics (debug)"}.get,
+        horizontal=True,
+    )
+
+    # Revised drawings: reuse the previous completed run of this session
+    baseline = st.session_state.get("last_workspace")
+    incremental_run = baseline is not None and st.checkbox(
+        f"Only reprocess changes since the previous run ({baseline.name})",
+        value=True,
+    )
+
     run_clicked = st.button(
         "Run Automation",
         type="primary",
@@ -68,92 +125,90 @@ if st.session_state["automation_status"] == "idle":
     )
 
     if run_clicked and ready:
+        st.session_state["output_profile"] = output_profile
+        # Collect paths to pass to the pipeline
+        input_paths = {k: st.session_state.get(f"{k}_saved_path") for k in required.keys()}
+        # New workspace for this run, drop old ones not used by queued/running jobs
+        workspace = Workspace.create()
+        active = [j.options["workspace"].root for j in job_runner.list() if not j.done and "workspace" in j.options]
+        keep = [workspace.root] + ([baseline.root] if baseline is not None else [])
+        cleanup_workspaces(keep=KEEP_WORKSPACES, exclude=active + keep)
+        # same for the upload folders of other sessions, queued jobs read theirs when they start
+        queued = [Path(path).parent for j in job_runner.list() if not j.done for path in j.input_paths.values()]
+        cleanup_workspaces(UPLOAD_DIR, keep=KEEP_UPLOADS, exclude=queued + [session_upload_dir])
+        from pipeline import CACHE_DIR
+        from stagecache import cleanup_cache
+        cleanup_cache(CACHE_DIR, max_bytes=CACHE_MAX_GB * 1024 ** 3)
+        job_id = job_runner.submit(input_paths, workspace=workspace, profile=output_profile,
+                                   baseline=baseline if incremental_run else None)
+        st.session_state["job_id"] = job_id
+        st.query_params["job"] = job_id
         st.session_state["automation_status"] = "running"
         st.rerun()
 
 elif st.session_state["automation_status"] == "running":
-    with st.spinner("Running automation..."):
-        # Collect paths to pass to your pipeline
-        input_paths = {k: st.session_state.get(f"{k}_saved_path") for k in required.keys()}
-        # TODO: call your actual processing function here, e.g.:
-        log_area = st.empty()
-        if "logs" not in st.session_state:
-            st.session_state.logs = []
-        def log(msg):
-            st.session_state.logs.append(msg)
-            log_area.code("\n".join(st.session_state.logs), language="text")
-        log("Starting automation...")
-        #####################################################################
-        # Step 1 Automation
-        log("Step 1/5: Calculating foundations SOPs from geometry file...")
-        import model1getsops
-        model1getsops.main()
-        time.sleep(1)
-        #####################################################################
-        # Step 2 Automation
-        log("Step 2/5: Generate foundations names from CAD busbar lanes...")
-        import model2namesfromlanes
-        model2namesfromlanes.main()
-        time.sleep(1)
-        #####################################################################
-        # Step 3 Automation
-        log("Step 3/5: Associate foundations CAD id text with SOPs info...")
-        import model3associatenames
-        model3associatenames.main()
-        time.sleep(1)
-        #####################################################################
-        # Step 4 Automation
-        log("Step 4/5: Checking data consistency between CAD files...")
-        import model41combineboqcad
-        model41combineboqcad.main()
-        log("Step 4/5: Matching CAD busbar lanes SOPs with excel BoQ info...")
-        time.sleep(1)
-        log("Step 4/5: Assigning foundation type to HV equipment as per design specs...")
-        import model42combineboqcad
-        model42combineboqcad.main()
-        time.sleep(0.5)
-        log("Step 4/5: Generating foundations 4 corners SOPs info...")
-        import model43combineboqcad
-        model43combineboqcad.main()
-        time.sleep(0.5)
-        log("Step 4/5: Generating CAD-QA control files...")
-        import model44cadqa
-        model44cadqa.main()
-        time.sleep(0.5)
-        log("Step 5/5: Generating busbar lanes tables...")
-        import model51sortbybusbarlane
-        model51sortbybusbarlane.main()
-        time.sleep(0.5)
-        log("Step 5/5: Generating drawing tables png files...")
-        import model52tabletoimage
-        model52tabletoimage.main()
-
-        # copy relevant files to download folder
-        script_dir = Path(__file__).resolve().parent
-        downloads_path = script_dir / "downloads"
-        file_1 = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
-        file_2 = script_dir / "shared" / "04_CAD_QA_Final.dxf"
-        import shutil
-        # Copy both files into the downloads folder
-        shutil.copy(file_1, downloads_path / file_1.name)
-        shutil.copy(file_2, downloads_path / file_2.name)
-        
-        log("Process completed!")
-        time.sleep(3)
+    job = job_runner.get(st.session_state.get("job_id"))
+    if job is None:
+        # Job no longer known (server restarted)
+        st.session_state["automation_status"] = "idle"
+        st.rerun()
+
+    # one snapshot of the queue, a worker can pick the job up at any time
+    queue = job_runner.queued()
+    queue_position = next((i + 1 for i, j in enumerate(queue) if j.id == job.id), 0)
+    with st.spinner("Waiting in queue..." if queue_position else "Running automation..."):
+        if queue_position:
+            st.info(f"Job {job.id} is queued (position {queue_position}).")
+        st.code("\n".join(job.logs) or "Waiting for a free worker...", language="text")
+
+        # Poll the job until it finishes
+        if not job.done:
+            time.sleep(1)
+            st.rerun()
 
     #########################################################################################
     # End of automation
     st.session_state["automation_status"] = "completed"
-    st.session_state["automation_completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    st.session_state.logs = []
+    st.session_state["automation_completed_at"] = job.finished_at.strftime("%Y-%m-%d %H:%M:%S")
     st.rerun()
 
 elif st.session_state["automation_status"] == "completed":
-    st.success(f"Automation completed at {st.session_state['automation_completed_at']}.")
-
-    # show download folder files
-    downloads_path = script_dir / "downloads"
-    files_in_downloads = sorted([f for f in downloads_path.iterdir() if f.is_file()])
+    job = job_runner.get(st.session_state.get("job_id"))
+    if job is not None and job.status == "failed":
+        st.error(f"Automation failed at {st.session_state['automation_completed_at']}.")
+        with st.expander("Show run log"):
+            st.code("\n".join(job.logs) + "\n\n" + job.error, language="text")
+        if job.result is not None:
+            import pandas as pd
+            st.dataframe(pd.DataFrame([{"stage": r.stage, "status": r.status, "error": r.error} for r in job.result.stages]),
+                         hide_index=True, use_container_width=True)
+        # Same workspace, completed stages are restored from their checkpoints
+        if job.failed_stage is not None and "workspace" in job.options:
+            st.info(f"Fix the input file(s) above, then resume from the {job.failed_stage} stage.")
+            if st.button("Resume Automation", type="primary", disabled=not ready):
+                input_paths = {k: st.session_state.get(f"{k}_saved_path") for k in required.keys()}
+                job_id = job_runner.submit(input_paths, **{**job.options, "resume": True})
+                st.session_state["job_id"] = job_id
+                st.query_params["job"] = job_id
+                st.session_state["automation_status"] = "running"
+                st.rerun()
+    else:
+        st.success(f"Automation completed at {st.session_state['automation_completed_at']}.")
+        if job is not None and job.result is not None:
+            # Per stage timings / counts, also saved as run_stats.json in the downloads
+            from stagestats import stats_table
+            st.subheader("Run stats")
+            st.dataframe(stats_table(job.result.stats), hide_index=True, use_container_width=True)
+            st.session_state["last_workspace"] = job.options.get("workspace")
+        if job is not None and job.result is not None and job.result.changes is not None:
+            from incremental import summary
+            with st.expander("Changes since the previous run: " + summary(job.result.changes)):
+                st.json(job.result.changes, expanded=False)
+
+    # show download folder files of the run workspace
+    workspace = job.options.get("workspace") if job is not None else None
+    downloads_path = (workspace or Workspace.default()).downloads
+    files_in_downloads = sorted([f for f in downloads_path.iterdir() if f.is_file()]) if downloads_path.exists() else []
 
     if files_in_downloads:
         # Radio selector
@@ -179,11 +234,13 @@ elif st.session_state["automation_status"] == "completed":
     # Optional: show where files came from
     with st.expander("Show input file paths"):
         for k, label in required.items():
-            st.write(f"• {label}: {st.session_state.get(f'{k}_saved_path')}")
+            st.write(f"• {label}: {job.input_paths.get(k) if job else st.session_state.get(f'{k}_saved_path')}")
 
     col_a, col_b = st.columns([1, 3])
     with col_a:
         restart = st.button("Restart Automation")
     if restart:
         st.session_state["automation_status"] = "idle"
+        st.session_state.pop("job_id", None)
+        st.query_params.pop("job", None)
         st.rerun()
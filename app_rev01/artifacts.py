@@ -0,0 +1,163 @@
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import xlsxwriter
+except ImportError:  # optional, openpyxl write-only mode is used without it
+    xlsxwriter = None
+
+### THIS SCRIPT ##################################################
+### Storage of intermediate tables in shared/ as Parquet (or    #
+### Feather by suffix): typed columns and fast reads. XLSX is   #
+### only written for the deliverables, streamed row by row with #
+### one number format per column (write_xlsx).                  #
+##################################################################
+
+# Suffix of intermediate tables
+TABLE_SUFFIX = ".parquet"
+
+# Deliverable workbooks: header row style and column number formats
+HEADER_STYLE = {"bold": True, "bg_color": "#D3D3D3", "border": 1}
+MM_FORMAT = "0.000"  # coordinates are in m, shown to the mm
+INTEGER_FORMAT = "0"
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+# Rows converted to Python values at a time while writing
+XLSX_CHUNK_ROWS = 10000
+
+
+def table_path(folder, stem):
+    """Path of the intermediate table stem in folder"""
+    return Path(folder) / f"{stem}{TABLE_SUFFIX}"
+
+
+def mixed_to_str(df):
+    """Object columns mixing numbers and text (common in hand-made BoQs) as text, missing values kept"""
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].map(lambda v: v if v is None or isinstance(v, str) or pd.isna(v) else str(v))
+    return df
+
+
+def write_table(df, path):
+    """Writes df to path (.parquet or .feather) and returns the path"""
+    path = Path(path)
+    try:
+        _write(df, path)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        _write(mixed_to_str(df), path)
+    return path
+
+
+def _write(df, path):
+    if path.suffix == ".feather":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_parquet(path, index=False)
+
+
+def read_table(path, columns=None):
+    """Reads an intermediate table, older .xlsx intermediates are still accepted"""
+    path = Path(path)
+    if path.suffix == ".feather":
+        return pd.read_feather(path, columns=columns)
+    if path.suffix in (".xlsx", ".xls"):
+        return pd.read_excel(path, usecols=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def column_format(name, dtype):
+    """Number format of a deliverable column, None for text and general numbers"""
+    if pd.api.types.is_float_dtype(dtype) and "(mm)" in str(name):
+        return MM_FORMAT
+    if pd.api.types.is_integer_dtype(dtype):
+        return INTEGER_FORMAT
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return DATETIME_FORMAT
+    return None
+
+
+def column_width(name):
+    return max(10, len(str(name)) + 2)
+
+
+def xlsx_rows(df):
+    """Rows of df as lists of Python values (missing values as None), converted XLSX_CHUNK_ROWS at a time"""
+    for start in range(0, len(df), XLSX_CHUNK_ROWS):
+        chunk = df.iloc[start:start + XLSX_CHUNK_ROWS]
+        columns = [chunk[col].astype(object).where(chunk[col].notna(), None).tolist() for col in chunk.columns]
+        yield from zip(*columns)
+
+
+def write_xlsx(sheets, path, formats=None):
+    """Writes a DataFrame (or {sheet name: DataFrame}) to an xlsx workbook row by row in bounded memory and
+    returns the path. formats overrides column_format per column name; formats are set once per column."""
+    path = Path(path)
+    if isinstance(sheets, pd.DataFrame):
+        sheets = {"Sheet1": sheets}
+    formats = formats or {}
+    sheet_formats = {name: [formats.get(col, column_format(col, dtype)) for col, dtype in df.dtypes.items()]
+                     for name, df in sheets.items()}
+    if xlsxwriter is not None:
+        _write_xlsxwriter(sheets, sheet_formats, path)
+    else:
+        _write_openpyxl(sheets, sheet_formats, path)
+    return path
+
+
+def _write_xlsxwriter(sheets, sheet_formats, path):
+    # constant_memory flushes every row to disk once the next one starts
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_formulas": False,
+                                          "strings_to_urls": False, "nan_inf_to_errors": True})
+    header = workbook.add_format(HEADER_STYLE)
+    cell_formats = {}
+    for name, df in sheets.items():
+        worksheet = workbook.add_worksheet(name)
+        for i, (col, number_format) in enumerate(zip(df.columns, sheet_formats[name])):
+            if number_format is not None and number_format not in cell_formats:
+                cell_formats[number_format] = workbook.add_format({"num_format": number_format})
+            worksheet.set_column(i, i, column_width(col), cell_formats.get(number_format))
+        worksheet.write_row(0, 0, [str(col) for col in df.columns], header)
+        worksheet.freeze_panes(1, 0)
+        for r, row in enumerate(xlsx_rows(df), 1):
+            worksheet.write_row(r, 0, row)
+    workbook.close()
+
+
+def _write_openpyxl(sheets, sheet_formats, path):
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Border, Font, PatternFill, Side
+    from openpyxl.utils import get_column_letter
+
+    side = Side(style="thin")
+    workbook = Workbook(write_only=True)
+    for name, df in sheets.items():
+        worksheet = workbook.create_sheet(name)
+        header = []
+        for i, col in enumerate(df.columns, 1):
+            worksheet.column_dimensions[get_column_letter(i)].width = column_width(col)
+            cell = WriteOnlyCell(worksheet, value=str(col))
+            cell.font = Font(bold=True)
+            cell.fill = PatternFill("solid", fgColor=HEADER_STYLE["bg_color"].lstrip("#"))
+            cell.border = Border(left=side, right=side, top=side, bottom=side)
+            header.append(cell)
+        worksheet.freeze_panes = "A2"
+        worksheet.append(header)
+
+        # write-only sheets have no column styles, formatted columns are written as styled cells
+        number_formats = sheet_formats[name]
+        for row in xlsx_rows(df):
+            cells = list(row)
+            for i, value in enumerate(cells):
+                if value is None:
+                    continue
+                if number_formats[i] is not None:
+                    cells[i] = WriteOnlyCell(worksheet, value=value)
+                    cells[i].number_format = number_formats[i]
+                elif isinstance(value, str) and value.startswith("="):
+                    # text, not a formula (same as xlsxwriter strings_to_formulas=False)
+                    cells[i] = WriteOnlyCell(worksheet, value=value)
+                    cells[i].data_type = "s"
+            worksheet.append(cells)
+    workbook.save(path)
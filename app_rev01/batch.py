@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import csv
+import json
+import os
+import re
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from workspace import Workspace
+
+### THIS SCRIPT ##################################################
+### Headless batch runs: processes a manifest of sites (the 5   #
+### input files app.py asks for) on a process pool, each site   #
+### in its own output folder, and writes a summary report.      #
+### Usage: python batch.py sites.json -o out/ --workers 4       #
+##################################################################
+
+# Manifest columns / keys besides the pipeline inputs (pipeline.INPUT_KEYS)
+NAME_KEY = "name"
+BASELINE_KEY = "baseline"
+# Written in every site folder / in the output folder
+LOG_FILE = "run.log"
+SUMMARY_FILE = "batch_summary.json"
+
+
+def read_manifest(path):
+    """Sites of a manifest as [{name, input key: path, ...}], relative paths are taken from the manifest folder.
+
+    JSON: a list of sites (or {"sites": [...]}), each {"name": ..., "ga_dxf": ..., "busbar_dxf": ..., ...}
+    CSV: one row per site with the same column names.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            sites = list(csv.DictReader(f))
+    else:
+        sites = json.loads(path.read_text(encoding="utf-8"))
+        if isinstance(sites, dict):
+            sites = sites["sites"]
+
+    for site in sites:
+        for key, value in site.items():
+            if key != NAME_KEY and value:
+                site[key] = str((path.parent / value).resolve()) if not Path(value).is_absolute() else value
+    return sites
+
+
+def site_name(site, i):
+    """Site name, "row i" when the manifest gives none"""
+    return (site.get(NAME_KEY) or "").strip() or f"row {i}"
+
+
+def check_sites(sites, input_keys):
+    """Problems of the manifest as {site name: [messages]}, sites without any are not listed"""
+    problems = {}
+    seen = set()
+    for i, site in enumerate(sites, 1):
+        name = site_name(site, i)
+        messages = []
+        if not (site.get(NAME_KEY) or "").strip():
+            messages.append("no site name")
+        elif not re.fullmatch(r"[\w.\- ]+", name) or re.fullmatch(r"[. ]+", name):
+            # "." / ".." would point at the output folder or its parent
+            messages.append("site name is not a valid folder name")
+        elif name in seen:
+            messages.append("duplicate site name")
+        seen.add(name)
+        for key in input_keys:
+            if not site.get(key):
+                messages.append(f"missing input {key}")
+            elif not Path(site[key]).is_file():
+                messages.append(f"{key} not found: {site[key]}")
+        if site.get(BASELINE_KEY) and not Path(site[BASELINE_KEY]).is_dir():
+            messages.append(f"baseline not found: {site[BASELINE_KEY]}")
+        if messages:
+            problems[name] = messages
+    return problems
+
+
+def run_site(name, input_paths, site_dir, baseline=None, profile="lean", use_cache=True, resume=False, log_level="INFO"):
+    """Runs the pipeline for one site in site_dir (process pool worker) and returns its summary entry.
+    The run log and the stage prints are written to site_dir/run.log (appended to when resuming)."""
+    import pipeline
+    import runlog
+
+    runlog.set_level(log_level)
+    workspace = Workspace(site_dir).create_folders()
+    entry = {"name": name, "workspace": str(workspace.root), "status": "failed", "started": datetime.now().isoformat(timespec="seconds")}
+    start = time.perf_counter()
+    with open(workspace.root / LOG_FILE, "a" if resume else "w", encoding="utf-8") as log_file:
+        def log(msg):
+            print(msg, file=log_file, flush=True)
+
+        try:
+            with contextlib.redirect_stdout(log_file):
+                result = pipeline.run_pipeline(input_paths, workspace=workspace, profile=profile, log=log, use_cache=use_cache,
+                                               baseline=Workspace(baseline) if baseline else None, resume=resume)
+            entry.update({
+                "status": "completed",
+                "foundations": len(result.foundations) if result.foundations is not None else None,
+                "circuits": len(result.circuit_tables),
+                "cached_stages": result.cached_stages,
+                "resumed_stages": [r.stage for r in result.stages if r.status == "resumed"],
+                "stages": {s.stage: round(s.wall_s, 3) for s in result.stats},
+                "downloads": [str(Path(p).relative_to(workspace.root)) for p in result.downloads],
+                "changes": result.changes and result.changes["circuits_changed"],
+            })
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+            if isinstance(e, pipeline.StageError):
+                entry["failed_stage"] = e.stage
+            log(traceback.format_exc())
+    entry["wall_s"] = round(time.perf_counter() - start, 3)
+    return entry
+
+
+def run_batch(sites, output_dir, workers=None, profile="lean", use_cache=True, baseline_dir=None, overwrite=False, resume=False,
+              log_level="INFO", log=print):
+    """Runs every site of the manifest into output_dir/<site name>/ and returns the summary report.
+    baseline_dir is an earlier batch output folder: sites found there are reprocessed incrementally.
+    resume reruns the sites that failed in an earlier batch into output_dir from their failed stage,
+    completed sites are skipped."""
+    from pipeline import CACHE_DIR, INPUT_KEYS
+    from stagecache import cleanup_cache
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = workers or min(len(sites), os.cpu_count() or 1) or 1
+    problems = check_sites(sites, INPUT_KEYS)
+    if use_cache:
+        # least recently used stage/DXF cache entries beyond the size limit
+        cleanup_cache(CACHE_DIR)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "output_dir": str(output_dir.resolve()),
+        "workers": workers,
+        "profile": profile,
+        "sites": [],
+    }
+    # site entries of the earlier batch in output_dir
+    previous_entries = {}
+    if resume and (output_dir / SUMMARY_FILE).exists():
+        previous = json.loads((output_dir / SUMMARY_FILE).read_text(encoding="utf-8"))
+        previous_entries = {entry["name"]: entry for entry in previous["sites"]}
+    previous_status = {name: entry["status"] for name, entry in previous_entries.items()}
+
+    jobs = {}
+    for i, site in enumerate(sites, 1):
+        name = site_name(site, i)
+        if name in problems:
+            report["sites"].append({"name": name, "status": "invalid", "error": "; ".join(problems[name])})
+            log(f"❌ {name}: {'; '.join(problems[name])}")
+            continue
+        site_dir = output_dir / name
+        if site_dir.resolve().parent != output_dir.resolve():
+            # never delete or write outside output_dir
+            report["sites"].append({"name": name, "status": "invalid", "error": f"{site_dir} is not a folder of {output_dir}"})
+            log(f"❌ {name}: {site_dir} is not a folder of {output_dir}")
+            continue
+        site_resume = resume and previous_status.get(name) == "failed" and site_dir.is_dir()
+        if site_dir.exists() and any(site_dir.iterdir()) and not site_resume:
+            if resume and previous_status.get(name) == "completed":
+                report["sites"].append(previous_entries[name])
+                log(f"⏭️ {name}: completed in the earlier batch")
+                continue
+            if not overwrite:
+                report["sites"].append({"name": name, "status": "skipped", "error": f"{site_dir} is not empty"})
+                log(f"⏭️ {name}: {site_dir} is not empty (use --overwrite)")
+                continue
+            shutil.rmtree(site_dir)
+        baseline = site.get(BASELINE_KEY)
+        if not baseline and baseline_dir is not None and (Path(baseline_dir) / name).is_dir():
+            baseline = str(Path(baseline_dir) / name)
+        jobs[name] = ({key: site[key] for key in INPUT_KEYS}, site_dir, baseline, site_resume)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_site, name, inputs, site_dir, baseline, profile, use_cache, site_resume,
+                                   log_level): name
+                   for name, (inputs, site_dir, baseline, site_resume) in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                # worker process died (e.g. out of memory)
+                entry = {"name": name, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+            report["sites"].append(entry)
+            if entry["status"] == "completed":
+                log(f"✅ {name}: {entry['foundations']} foundations, {entry['circuits']} circuits in {entry['wall_s']:.1f}s")
+            else:
+                stage = f" at {entry['failed_stage']}" if entry.get("failed_stage") else ""
+                log(f"❌ {name}{stage}: {entry['error']} (see {output_dir / name / LOG_FILE})")
+
+    # manifest order in the report
+    order = {site_name(site, i): i for i, site in enumerate(sites, 1)}
+    report["sites"].sort(key=lambda entry: order.get(entry["name"], len(order)))
+    report["completed"] = sum(entry["status"] == "completed" for entry in report["sites"])
+    report["failed"] = len(report["sites"]) - report["completed"]
+    summary_path = output_dir / SUMMARY_FILE
+    summary_path.write_text(json.dumps(report, indent=2, default=str))
+    log(f"{report['completed']} of {len(report['sites'])} sites completed, summary saved at: {summary_path}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pipeline for every site of a manifest")
+    parser.add_argument("manifest", help="JSON or CSV manifest with a name and the 5 input files per site")
+    parser.add_argument("-o", "--output-dir", default="batch_" + datetime.now().strftime("%Y%m%d-%H%M%S"),
+                        help="one folder per site is created here")
+    parser.add_argument("--workers", type=int, help="sites processed at the same time (default: CPU count)")
+    parser.add_argument("--profile", choices=["lean", "debug"], default="lean",
+                        help="lean writes the deliverables only, debug also the per stage diagnostics in each site's shared/")
+    parser.add_argument("--no-cache", action="store_true", help="recompute every stage")
+    parser.add_argument("--baseline-dir", help="earlier batch output folder, sites found there are reprocessed incrementally")
+    parser.add_argument("--overwrite", action="store_true", help="replace existing site folders in the output folder")
+    parser.add_argument("--resume", action="store_true",
+                        help="rerun the sites that failed in an earlier batch into the same output folder, from their failed stage")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of each site's run.log (DEBUG adds per item details)")
+    args = parser.parse_args(argv)
+
+    sites = read_manifest(args.manifest)
+    report = run_batch(sites, args.output_dir, args.workers, args.profile, not args.no_cache, args.baseline_dir, args.overwrite,
+                       args.resume, args.log_level)
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+import ezdxf
+import pandas as pd
+
+import pipeline
+from workspace import Workspace
+
+### THIS SCRIPT ##################################################
+### Benchmarks every pipeline stage on synthetic sites.         #
+### A site has C circuits of 3 busbar lanes (L1-L3) with P      #
+### foundations per lane, so 3*C lanes and 3*C*P foundations.   #
+### Usage: python benchmark.py --sizes 5x20 20x50 -o bench.json #
+##################################################################
+
+# Lane spacing / foundation pitch along a lane (m)
+PITCH = 4.0
+# Site origin, same area as the real drawings
+ORIGIN = (265000.0, 897000.0)
+EQUIPMENT_TYPES = {"HLPI": ("TYPE 1", 1500), "CT": ("TYPE 2", 1800), "VT": ("TYPE 3", 2000)}
+# Every Nth foundation gets a drawing ID that doesn't match the BoQ (NO MATCH rows)
+UNMATCHED_EVERY = 7
+
+
+def generate_site(output_dir, circuits, per_lane):
+    """Writes the 5 pipeline inputs for a synthetic site to output_dir and returns {input key: path}"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    ga = ezdxf.new()
+    lanes = ezdxf.new()
+    texts = ezdxf.new()
+    ga_msp, lanes_msp, texts_msp = ga.modelspace(), lanes.modelspace(), texts.modelspace()
+
+    boq = []
+    n = 0
+    x0, y0 = ORIGIN
+    for circuit in range(circuits):
+        for lane in range(3):
+            y = y0 + (circuit * 3 + lane) * PITCH
+            lanes_msp.add_line((x0 - 1, y), (x0 + per_lane * PITCH, y), dxfattribs={"layer": f"Bus_P1_C{circuit}"})
+            for p in range(per_lane):
+                x = x0 + p * PITCH
+                n += 1
+                # foundation outline (perimeter 6) plus a larger pad that model1 filters out
+                ga_msp.add_3dface([(x - 0.75, y - 0.75, 0), (x + 0.75, y - 0.75, 0), (x + 0.75, y + 0.75, 0), (x - 0.75, y + 0.75, 0)])
+                ga_msp.add_3dface([(x - 1, y - 1, 0), (x + 1, y - 1, 0), (x + 1, y + 1, 0), (x - 1, y + 1, 0)])
+                prefix = "G" if n % UNMATCHED_EVERY == 0 else "F"
+                texts_msp.add_mtext(f"{prefix}{n:05d}", dxfattribs={"insert": (x + 0.3, y + 0.2)})
+                boq.append({"CIRCUIT REF": f"C{circuit}", "FOUNDATION REF": f"F{n:05d}", "DUCT REQUIRED": "NO",
+                            "RATING (Kv)": 400, "PHASE": "3PH", "EQUIPMENT": list(EQUIPMENT_TYPES)[n % 3],
+                            "DESCRPTION": None, "EASTING (mm) ": None, "NORTHING (mm) ": None,
+                            "FOUNDATION TYPE": None, "FOUNDATION (T.O.C)": None})
+
+    paths = {
+        "ga_dxf": output_dir / "01_shapes_foundation_all_.dxf",
+        "busbar_dxf": output_dir / "02_Aug25_busbarlanes.dxf",
+        "found_id_dxf": output_dir / "03_Drawing_All_Text_Export.dxf",
+        "found_type_sheet": output_dir / "04_Design_Foundations_Type.xlsx",
+        "boq_sheet": output_dir / "CAAR-BOQ.xlsx",
+    }
+    ga.saveas(paths["ga_dxf"])
+    lanes.saveas(paths["busbar_dxf"])
+    texts.saveas(paths["found_id_dxf"])
+    pd.DataFrame(boq).to_excel(paths["boq_sheet"], index=False)
+    pd.DataFrame({"EQUIPMENT": list(EQUIPMENT_TYPES),
+                  "FOUNDATION TYPE": [t for t, _ in EQUIPMENT_TYPES.values()],
+                  "WIDTH (mm)": [w for _, w in EQUIPMENT_TYPES.values()]}).to_excel(paths["found_type_sheet"], index=False)
+    return paths
+
+
+def run_stages(input_paths, workspace, memory=False, skip=()):
+    """Runs the pipeline stages one by one (no cache) and returns [{stage, wall_s, peak_mb}].
+    Only stages nothing else depends on (cad_qa, drawing_tables) can be skipped."""
+    workspace.create_folders()
+    ctx = pipeline.Context(workspace)
+    values = dict(input_paths)
+    timings = []
+    for stage in pipeline.STAGES:
+        if stage.name in skip:
+            continue
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        # stage prints are not part of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            outputs, _ = stage.func(ctx, **{name: values[name] for name in stage.inputs}, **stage.params)
+        wall = time.perf_counter() - start
+        row = {"stage": stage.name, "wall_s": round(wall, 4)}
+        if memory:
+            row["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+            tracemalloc.stop()
+        timings.append(row)
+        values.update(outputs)
+    return timings
+
+
+def benchmark_size(work_dir, circuits, per_lane, repeat=1, memory=True, skip=()):
+    """Times each stage (best of repeat) and measures its peak Python memory in an extra traced run"""
+    site_dir = Path(work_dir) / f"site_{circuits}x{per_lane}"
+    start = time.perf_counter()
+    input_paths = generate_site(site_dir / "inputs", circuits, per_lane)
+    generate_s = time.perf_counter() - start
+
+    best = {}
+    for i in range(repeat):
+        for row in run_stages(input_paths, Workspace(site_dir / f"run{i}"), skip=skip):
+            best[row["stage"]] = min(best.get(row["stage"], row["wall_s"]), row["wall_s"])
+    # tracemalloc slows Python code down a lot, so memory gets its own run
+    peaks = {}
+    if memory:
+        peaks = {row["stage"]: row["peak_mb"] for row in run_stages(input_paths, Workspace(site_dir / "traced"), True, skip)}
+
+    stages = [{"stage": name, "wall_s": wall, "peak_mb": peaks.get(name)} for name, wall in best.items()]
+    return {
+        "size": f"{circuits}x{per_lane}",
+        "circuits": circuits,
+        "lanes": circuits * 3,
+        "foundations": circuits * 3 * per_lane,
+        "generate_s": round(generate_s, 4),
+        "total_s": round(sum(best.values()), 4),
+        "stages": stages,
+    }
+
+
+def compare(report, baseline):
+    """Prints wall time ratios current/baseline for the sizes and stages found in both reports"""
+    old = {(r["size"], s["stage"]): s["wall_s"] for r in baseline["results"] for s in r["stages"]}
+    for result in report["results"]:
+        for s in result["stages"]:
+            before = old.get((result["size"], s["stage"]))
+            if before:
+                print(f"{result['size']:>8} {s['stage']:<16} {before:9.3f}s -> {s['wall_s']:9.3f}s  x{s['wall_s'] / before:.2f}")
+
+
+def parse_size(text):
+    circuits, per_lane = text.lower().split("x")
+    return int(circuits), int(per_lane)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic sites")
+    parser.add_argument("--sizes", nargs="+", default=["2x10", "5x20", "10x40"],
+                        help="site sizes as CIRCUITSxFOUNDATIONS_PER_LANE")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per size, the best one is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--skip", nargs="+", default=[], choices=["cad_qa", "drawing_tables"],
+                        help="leave out slow output stages")
+    parser.add_argument("--work-dir", help="keep generated sites and outputs here instead of a temp folder")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON report path")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "skipped": args.skip,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(args.work_dir or tmp)
+        for size in args.sizes:
+            circuits, per_lane = parse_size(size)
+            print(f"Benchmarking {size} ({circuits * 3 * per_lane} foundations)...")
+            result = benchmark_size(work_dir, circuits, per_lane, args.repeat, not args.no_memory, args.skip)
+            report["results"].append(result)
+            for s in result["stages"]:
+                peak = "" if s["peak_mb"] is None else f"{s['peak_mb']:9.1f} MB"
+                print(f"  {s['stage']:<16} {s['wall_s']:9.3f}s {peak}")
+            print(f"  {'total':<16} {result['total_s']:9.3f}s")
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"✅ Report saved at: {args.output}")
+    if args.baseline:
+        compare(report, json.loads(Path(args.baseline).read_text()))
+    return report
+
+
+if __name__ == "__main__":
+    main()
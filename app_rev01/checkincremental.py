@@ -0,0 +1,136 @@
+import argparse
+import contextlib
+import io
+import random
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+import ezdxf
+
+import pipeline
+import model52tabletoimage
+from benchmark import generate_site
+from workspace import Workspace
+
+### THIS SCRIPT ##################################################
+### Checks incremental runs against full recomputation. A       #
+### synthetic site is run in full, revised at random (lanes,    #
+### ID texts and foundations removed or moved), then the        #
+### revision is run incrementally against the first run and in  #
+### full. Both must give the same tables and drawingdata zip.   #
+### Usage: python checkincremental.py --seeds 10                #
+##################################################################
+
+# Tables of the PipelineResult compared between the two runs
+RESULT_TABLES = ["sops", "foundations", "lane_names", "text_names", "new_vs_old", "boq_sops", "corners"]
+
+
+def revise_site(input_paths, output_dir, rng):
+    """Copies the site inputs to output_dir with random edits. Entities are deleted or moved in place, so the
+    drawing order of the kept ones is unchanged (the incremental path, not its full fallback).
+    Returns ({input key: path}, [edit descriptions])."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = {key: Path(shutil.copy2(path, output_dir / Path(path).name)) for key, path in input_paths.items()}
+    edits = []
+
+    # lanes: one line, or every line of a circuit (the circuit drops out of the tables)
+    doc = ezdxf.readfile(paths["busbar_dxf"])
+    lines = list(doc.modelspace().query("LINE"))
+    if rng.random() < 0.5:
+        layer = rng.choice(sorted({line.dxf.layer for line in lines}))
+        removed = [line for line in lines if line.dxf.layer == layer]
+        edits.append(f"removed the lanes of {layer}")
+    else:
+        removed = [rng.choice(lines)]
+        edits.append(f"removed a lane of {removed[0].dxf.layer}")
+    for line in removed:
+        doc.modelspace().delete_entity(line)
+    doc.saveas(paths["busbar_dxf"])
+
+    # ID texts: a few moved (some beyond the snapping radius), one removed
+    doc = ezdxf.readfile(paths["found_id_dxf"])
+    texts = list(doc.modelspace().query("MTEXT"))
+    for text in rng.sample(texts, min(3, len(texts))):
+        x, y = text.dxf.insert.x, text.dxf.insert.y
+        text.dxf.insert = (x + rng.uniform(-2.5, 2.5), y + rng.uniform(-2.5, 2.5))
+    removed = rng.choice(texts)
+    edits.append(f"moved 3 texts, removed {removed.text}")
+    doc.modelspace().delete_entity(removed)
+    doc.saveas(paths["found_id_dxf"])
+
+    # foundations: 2 3DFACEs each (outline and pad), one removed and one moved
+    doc = ezdxf.readfile(paths["ga_dxf"])
+    faces = list(doc.modelspace().query("3DFACE"))
+    removed, moved = rng.sample(range(len(faces) // 2), 2)
+    for face in faces[2 * removed:2 * removed + 2]:
+        doc.modelspace().delete_entity(face)
+    dx, dy = rng.uniform(-0.6, 0.6), rng.uniform(-0.6, 0.6)
+    for face in faces[2 * moved:2 * moved + 2]:
+        for name in ("vtx0", "vtx1", "vtx2", "vtx3"):
+            v = face.dxf.get(name)
+            face.dxf.set(name, (v.x + dx, v.y + dy, v.z))
+    edits.append(f"removed foundation {removed + 1}, moved foundation {moved + 1}")
+    doc.saveas(paths["ga_dxf"])
+    return paths, edits
+
+
+def run(input_paths, workspace, baseline=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return pipeline.run_pipeline(input_paths, workspace, log=lambda msg: None, use_cache=False, baseline=baseline)
+
+
+def differences(incremental, full, workspaces):
+    """Names of the outputs that differ between the two PipelineResults (and their (incremental, full) Workspaces)"""
+    diffs = [name for name in RESULT_TABLES if not getattr(incremental, name).equals(getattr(full, name))]
+    if list(incremental.circuit_tables) != list(full.circuit_tables) or \
+            not all(df.equals(full.circuit_tables[name]) for name, df in incremental.circuit_tables.items()):
+        diffs.append("circuit_tables")
+
+    # same files in the zip, PNGs of the same tables (reused baseline PNGs included)
+    zips = [sorted(zipfile.ZipFile(result.downloads[0]).namelist()) for result in (incremental, full)]
+    if zips[0] != zips[1]:
+        diffs.append("drawingdata.zip")
+    hashes = [{png.stem: model52tabletoimage.png_hash(png) for png in workspace.drawingdata.glob("*.png")}
+              for workspace in workspaces]
+    if hashes[0] != hashes[1]:
+        diffs.append("table images")
+    return diffs
+
+
+def check_seed(work_dir, seed, circuits, per_lane):
+    """Runs one random revision, returns (edits, differing outputs)"""
+    rng = random.Random(seed)
+    site_dir = Path(work_dir) / f"seed{seed}"
+    inputs = generate_site(site_dir / "inputs", circuits, per_lane)
+    baseline = Workspace(site_dir / "baseline")
+    run(inputs, baseline)
+
+    revised, edits = revise_site(inputs, site_dir / "revised_inputs", rng)
+    workspaces = Workspace(site_dir / "incremental"), Workspace(site_dir / "full")
+    incremental = run(revised, workspaces[0], baseline=baseline)
+    full = run(revised, workspaces[1])
+    return edits, differences(incremental, full, workspaces)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check incremental runs against full recomputation")
+    parser.add_argument("--seeds", type=int, default=5, help="random revisions checked")
+    parser.add_argument("--size", default="4x8", help="site size as CIRCUITSxFOUNDATIONS_PER_LANE")
+    parser.add_argument("--work-dir", help="keep generated sites and workspaces here instead of a temp folder")
+    args = parser.parse_args(argv)
+
+    circuits, per_lane = (int(n) for n in args.size.lower().split("x"))
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for seed in range(args.seeds):
+            edits, diffs = check_seed(Path(args.work_dir or tmp), seed, circuits, per_lane)
+            failed += bool(diffs)
+            print(f"{'❌' if diffs else '✅'} seed {seed}: {'; '.join(edits)}" + (f" -> differs: {', '.join(diffs)}" if diffs else ""))
+    print(f"{args.seeds - failed} of {args.seeds} revisions identical to a full run")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,67 @@
+import json
+import shutil
+import uuid
+from pathlib import Path
+import numpy as np
+
+from stagecache import file_hash, touch
+
+### THIS SCRIPT ##################################################
+### Parse-once cache of the uploaded DXFs. The entities a stage #
+### needs (3DFACE vertices, lane vertices, text inserts) are    #
+### extracted once per file content into .npy arrays (loaded    #
+### memory-mapped) plus a JSON of their strings, so reruns and  #
+### parameter changes don't parse the same DXF again.           #
+##################################################################
+
+# Bump when an extraction changes so older entries are not read
+FORMAT_VERSION = "1"
+
+
+def entry_dir(cache_dir, file_path, kind):
+    """Cache folder of one kind of entities of a DXF: <cache_dir>/<content hash>/<kind>"""
+    return Path(cache_dir) / file_hash(file_path) / f"{kind}.v{FORMAT_VERSION}"
+
+
+def load(file_path, kind, extract, cache_dir=None):
+    """Entities of file_path as {name: array or list of strings}. extract(file_path) returns the same dict
+    and is only called on a cache miss. Arrays are memory-mapped read only, cache_dir=None disables the cache."""
+    if cache_dir is None:
+        return extract(file_path)
+
+    entry = entry_dir(cache_dir, file_path, kind)
+    if not (entry / "strings.json").exists():
+        store(entry, extract(file_path))
+    else:
+        touch(entry)
+    strings = json.loads((entry / "strings.json").read_text(encoding="utf-8"))
+    arrays = {path.stem: np.load(path, mmap_mode="r") for path in entry.glob("*.npy")}
+    return {**arrays, **strings}
+
+
+def store(entry, entities):
+    # unique tmp folder, other runs may extract the same file concurrently
+    tmp = entry.with_name(f"{entry.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.mkdir(parents=True)
+    strings = {}
+    for name, value in entities.items():
+        if isinstance(value, np.ndarray):
+            np.save(tmp / f"{name}.npy", value)
+        else:
+            strings[name] = list(value)
+    # written last, marks the entry as complete
+    (tmp / "strings.json").write_text(json.dumps(strings), encoding="utf-8")
+
+    try:
+        tmp.rename(entry)
+    except OSError:
+        # another run stored it first, same key means same content
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def pack_lines(lines):
+    """[(n, 2) vertices per line] -> (vertices (N, 2), offsets (len + 1)); line i is vertices[offsets[i]:offsets[i + 1]]"""
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(line) for line in lines])
+    vertices = np.array([xy for line in lines for xy in line], dtype=float).reshape(-1, 2)
+    return vertices, offsets
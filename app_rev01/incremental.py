@@ -0,0 +1,145 @@
+import pickle
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+### THIS SCRIPT ##################################################
+### Incremental reprocessing of revised drawings. Every run     #
+### saves its extracted site state; a run given a baseline      #
+### reuses the lane / text assignment of unaffected foundations #
+### (model2, model3) and reports what changed since then.       #
+##################################################################
+
+# Extracted site state saved in shared/ by every run
+STATE_FILE = "site_state.pkl"
+# Change report saved next to the deliverables
+REPORT_FILE = "change_report.json"
+# A removed and an added foundation closer than this (m) are reported as moved
+MOVE_DISTANCE = 5.0
+# Stage outputs kept in the site state
+STATE_KEYS = ["sops", "lane_state", "text_state", "lane_names", "new_vs_old", "circuit_tables"]
+
+
+def save_state(path, values):
+    with open(path, "wb") as f:
+        pickle.dump({key: values.get(key) for key in STATE_KEYS}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return Path(path)
+
+
+def load_state(path):
+    """Site state of an earlier run, None when it has none"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def foundation_outlines(sops_df):
+    """One row per foundation: center and perimeter"""
+    return sops_df.drop_duplicates("element")[["center_x", "center_y", "perimeter"]].reset_index(drop=True)
+
+
+def diff_foundations(old_sops, new_sops, move_distance=MOVE_DISTANCE):
+    """Foundations added / removed (by center and perimeter), pairs of them within move_distance as moved"""
+    old = foundation_outlines(old_sops)
+    new = foundation_outlines(new_sops)
+    both = old.merge(new, how="outer", indicator=True)
+    removed = both[both["_merge"] == "left_only"].drop(columns="_merge").reset_index(drop=True)
+    added = both[both["_merge"] == "right_only"].drop(columns="_merge").reset_index(drop=True)
+
+    # Pair each removed foundation with the closest unpaired added one
+    moved = []
+    if len(removed) and len(added):
+        from scipy.spatial import cKDTree
+        tree = cKDTree(added[["center_x", "center_y"]].to_numpy())
+        distances, nearest = tree.query(removed[["center_x", "center_y"]].to_numpy(), k=1,
+                                        distance_upper_bound=move_distance)
+        paired = set()
+        for r in np.argsort(distances):
+            a = nearest[r]
+            if np.isfinite(distances[r]) and a not in paired:
+                paired.add(a)
+                moved.append((r, a, float(distances[r])))
+        moved_removed = {r for r, _, _ in moved}
+        moved_added = {a for _, a, _ in moved}
+    else:
+        moved_removed = moved_added = set()
+
+    def records(df, skip):
+        return [{"x": float(row.center_x), "y": float(row.center_y), "perimeter": float(row.perimeter)}
+                for i, row in enumerate(df.itertuples()) if i not in skip]
+
+    return {
+        "previous": len(old),
+        "current": len(new),
+        "unchanged": int((both["_merge"] == "both").sum()),
+        "added": records(added, moved_added),
+        "removed": records(removed, moved_removed),
+        "moved": [{"from": [float(removed.center_x[r]), float(removed.center_y[r])],
+                   "to": [float(added.center_x[a]), float(added.center_y[a])],
+                   "distance": round(d, 3)} for r, a, d in moved],
+    }
+
+
+def diff_lanes(old_state, new_state):
+    """Lanes added / removed (by layer and geometry), reported by lane name"""
+    def lanes(state):
+        # empty state when the lanes could not be read
+        return {(layer, wkb): name for name, layer, wkb in zip(state.get("names", []), state.get("layers", []), state.get("wkb", []))}
+
+    old, new = lanes(old_state), lanes(new_state)
+    return {
+        "previous": len(old),
+        "current": len(new),
+        "added": sorted(new[key] for key in new.keys() - old.keys()),
+        "removed": sorted(old[key] for key in old.keys() - new.keys()),
+    }
+
+
+def diff_names(old_names, new_names):
+    """Foundations whose lane name changed, joined on coordinates"""
+    key = ["EASTING (mm)", "NORTHING (mm)"]
+    both = old_names[key + ["FOUNDATION REF"]].merge(new_names[key + ["FOUNDATION REF"]], on=key, suffixes=(" OLD", " NEW"))
+    renamed = both[both["FOUNDATION REF OLD"] != both["FOUNDATION REF NEW"]]
+    return [{"x": float(row[0]), "y": float(row[1]), "old": row[2], "new": row[3]} for row in renamed.itertuples(index=False)]
+
+
+def diff_match_status(old_new_vs_old, new_new_vs_old):
+    """Foundation refs whose Match Status changed"""
+    columns = ["FOUNDATION REF", "Match Status"]
+    both = old_new_vs_old[columns].merge(new_new_vs_old[columns], on="FOUNDATION REF", how="outer", suffixes=(" OLD", " NEW"))
+    changed = both[both["Match Status OLD"].fillna("") != both["Match Status NEW"].fillna("")]
+    return [{"ref": row[0], "old": row[1] if pd.notna(row[1]) else None, "new": row[2] if pd.notna(row[2]) else None}
+            for row in changed.itertuples(index=False)]
+
+
+def changed_circuits(old_tables, new_tables):
+    """Circuit tables added, removed or with different content"""
+    names = set(old_tables) | set(new_tables)
+    return sorted(name for name in names
+                  if name not in old_tables or name not in new_tables or not old_tables[name].equals(new_tables[name]))
+
+
+def change_report(previous, values, baseline=None):
+    """Differences between the site state of an earlier run and this run's stage values"""
+    lane_state, text_state = values["lane_state"], values["text_state"]
+    return {
+        "baseline": str(baseline) if baseline is not None else None,
+        "foundations": diff_foundations(previous["sops"], values["sops"]),
+        "lanes": diff_lanes(previous["lane_state"], lane_state),
+        "renamed": diff_names(previous["lane_names"], values["lane_names"]),
+        "match_status": diff_match_status(previous["new_vs_old"], values["new_vs_old"]),
+        "circuits_changed": changed_circuits(previous["circuit_tables"], values["circuit_tables"]),
+        "points_recomputed": lane_state.get("recomputed"),
+        "texts_recomputed": text_state.get("recomputed"),
+    }
+
+
+def summary(report):
+    """One line summary for the run log"""
+    f = report["foundations"]
+    return (f"Foundations: +{len(f['added'])} -{len(f['removed'])} moved {len(f['moved'])}, "
+            f"lanes: +{len(report['lanes']['added'])} -{len(report['lanes']['removed'])}, "
+            f"renamed: {len(report['renamed'])}, match status changed: {len(report['match_status'])}, "
+            f"circuits changed: {len(report['circuits_changed'])}")
@@ -0,0 +1,92 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+import pandas as pd
+
+try:
+    import python_calamine  # noqa: F401
+    XLSX_ENGINE = "calamine"  # Rust reader, several times faster than openpyxl
+except ImportError:  # optional, pandas' default (openpyxl) is used without it
+    XLSX_ENGINE = None
+
+### THIS SCRIPT ##################################################
+### Typed reads of the uploaded spreadsheets. Each sheet has a  #
+### declared schema: headers are checked before the data is     #
+### parsed and only the schema columns are read, with their      #
+### dtypes (categoricals for the repeated reference columns).    #
+##################################################################
+
+
+@dataclass
+class SheetSchema:
+    label: str                                    # upload name used in error messages
+    required: dict                                # {column: dtype}, dtype None is inferred
+    optional: dict = field(default_factory=dict)  # read when present
+    keep_other: bool = False                      # also read the columns not in the schema
+
+
+# Client BoQ, only the columns carried into the deliverable are read. The BoQ coordinates and level
+# are replaced by the CAD ones (model42 drops them), so their values can be anything (e.g. "TBC")
+BOQ_SCHEMA = SheetSchema(
+    "BoQ Spreadsheet",
+    required={
+        "CIRCUIT REF": "category",
+        "FOUNDATION REF": "category",
+        "EQUIPMENT": "category",
+        "DESCRPTION": "str",
+        "EASTING (mm)": None,
+        "NORTHING (mm)": None,
+        "FOUNDATION TYPE": None,  # overwritten by the design types
+        "FOUNDATION (T.O.C)": None,
+    },
+    optional={
+        "DUCT REQUIRED": "str",
+        "RATING (Kv)": None,
+        "PHASE": "str",
+    },
+)
+
+# Design foundation types, small sheet: extra columns (e.g. a length column for model43) are kept
+FOUNDATION_TYPES_SCHEMA = SheetSchema(
+    "Design Foundations Type",
+    required={
+        "EQUIPMENT": "category",
+        "FOUNDATION TYPE": "str",
+        "WIDTH (mm)": "float64",
+    },
+    keep_other=True,
+)
+
+
+class SheetError(ValueError):
+    """Uploaded sheet doesn't match its schema"""
+
+
+def sheet_columns(path, schema, sheet_name=0):
+    """Checks the header row of a sheet against schema. Returns {schema column: column name in the sheet}
+    (names are matched ignoring surrounding spaces) plus the other columns when schema.keep_other."""
+    # openpyxl streams the header row, calamine would parse the whole sheet
+    header = pd.read_excel(path, sheet_name=sheet_name, nrows=0, engine="openpyxl").columns
+    found = {}
+    for name in header:
+        found.setdefault(str(name).strip(), name)
+
+    missing = [col for col in schema.required if col not in found]
+    if missing:
+        raise SheetError(f"{schema.label} ({Path(path).name}) is missing columns: {', '.join(missing)}")
+
+    columns = {col: found[col] for col in [*schema.required, *schema.optional] if col in found}
+    if schema.keep_other:
+        columns.update({col: name for col, name in found.items() if col not in columns})
+    return columns
+
+
+def read_sheet(path, schema, sheet_name=0):
+    """Reads the schema columns of a sheet with their dtypes, column names as in the sheet"""
+    columns = sheet_columns(path, schema, sheet_name)
+    dtypes = {**schema.required, **schema.optional}
+    dtype = {name: dtypes[col] for col, name in columns.items() if dtypes.get(col) is not None}
+    try:
+        return pd.read_excel(path, sheet_name=sheet_name, usecols=list(columns.values()), dtype=dtype,
+                             engine=XLSX_ENGINE)
+    except (ValueError, TypeError) as e:
+        raise SheetError(f"{schema.label} ({Path(path).name}): {e}") from e
@@ -0,0 +1,105 @@
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from runlog import get_logger
+
+logger = get_logger(__name__)
+
+### THIS SCRIPT ##################################################
+### Runs pipeline jobs on worker threads outside the Streamlit  #
+### script run. Jobs are queued, log their progress per stage   #
+### and are kept in memory so a reconnecting browser can poll   #
+### them again by id.                                           #
+##################################################################
+
+
+@dataclass
+class Job:
+    id: str
+    input_paths: dict
+    options: dict
+    status: str = "queued"  # queued | running | completed | failed
+    logs: list = field(default_factory=list)
+    stage: str = None
+    error: str = None
+    failed_stage: str = None
+    result: object = None  # PipelineResult, partial when the run failed at a stage
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime = None
+    finished_at: datetime = None
+
+    @property
+    def done(self):
+        # finished_at is set before the final status, so a done job always has both
+        return self.finished_at is not None and self.status in ("completed", "failed")
+
+    def log(self, msg):
+        self.stage = msg
+        self.logs.append(msg)
+
+
+class JobRunner:
+    """Queue of pipeline jobs executed by max_workers threads"""
+
+    def __init__(self, max_workers=1, max_jobs=50, prewarm=False):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.prewarm_timings = None
+        if prewarm:
+            # load the pipeline modules in the background while the user uploads files
+            threading.Thread(target=self._prewarm, name="pipeline-prewarm", daemon=True).start()
+
+    def _prewarm(self):
+        import pipeline
+        self.prewarm_timings = pipeline.prewarm(log=logger.info)
+
+    def submit(self, input_paths, **options):
+        """Queues a run_pipeline(input_paths, **options) job and returns its id"""
+        job = Job(uuid.uuid4().hex[:12], dict(input_paths), options)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+        self.executor.submit(self._run, job)
+        return job.id
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def queued(self):
+        return [job for job in self.list() if job.status == "queued"]
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job.id]
+
+    def _run(self, job):
+        import pipeline
+
+        job.status = "running"
+        job.started_at = datetime.now()
+        job.log("Starting automation...")
+        status = "failed"
+        try:
+            job.result = pipeline.run_pipeline(job.input_paths, log=job.log, **job.options)
+            status = "completed"
+        except Exception as e:
+            job.error = f"{e}\n{traceback.format_exc()}"
+            # stage errors carry the results of the stages run before the failure
+            job.failed_stage = getattr(e, "stage", None)
+            job.result = getattr(e, "result", None)
+            job.log(f"Error: {e}")
+        finally:
+            # pollers read finished_at as soon as the status is final, so it goes first
+            job.finished_at = datetime.now()
+            job.status = status
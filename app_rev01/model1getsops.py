@@ -1,116 +1,186 @@
 import ezdxf
-import math
-import csv
+import numpy as np
 from pathlib import Path
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import table_path, write_table
+import dxfcache
 import pandas as pd
 
-def main():
-    def distance(p1, p2):
-        return math.sqrt((p2[0] - p1[0]) ** 2 +
-                         (p2[1] - p1[1]) ** 2 +
-                         (p2[2] - p1[2]) ** 2)
-
-    def average_center(points):
-        x_vals = [pt[0] for pt in points]
-        y_vals = [pt[1] for pt in points]
-        center_x = sum(x_vals) / len(x_vals)
-        center_y = sum(y_vals) / len(y_vals)
-        return (round(center_x, 3), round(center_y, 3))
-
-    def process_and_export(file_path, output_csv, output_dxf):
-        try:
-            doc = ezdxf.readfile(file_path)
-            msp = doc.modelspace()
-
-            # New DXF output
-            new_doc = ezdxf.new(dxfversion='R2010')
-            new_msp = new_doc.modelspace()
-
-            results = []
-
-            for index, entity in enumerate(msp):
-                if entity.dxftype() == "3DFACE":
-                    points = [entity.dxf.vtx0, entity.dxf.vtx1, entity.dxf.vtx2]
-                    if hasattr(entity.dxf, 'vtx3') and entity.dxf.vtx3 != entity.dxf.vtx2:
-                        points.append(entity.dxf.vtx3)
-
-                    perimeter = sum(distance(points[i], points[(i + 1) % len(points)]) for i in range(len(points)))
-
-                    # Inside the loop, after perimeter and center have been calculated
-                    if 5.9 <= perimeter <= 6.1:
-                        center = average_center(points)
-                        element_name = f"3DFACE_{index}"
-
-                        # Write each vertex row to CSV
-                        for pt in points:
-                            results.append([
-                                    element_name,
-                                    round(pt[0], 3),
-                                    round(pt[1], 3),
-                                    round(pt[2], 3),
-                                    round(perimeter, 3),
-                                    round(center[0], 3),  # center_x
-                                    round(center[1], 3)   # center_y
-                                ])
-
-
-                        # Add polyline to DXF
-                        poly_points = [(pt[0], pt[1]) for pt in points]
-                        poly_points.append(poly_points[0])  # close it
-                        new_msp.add_lwpolyline(poly_points, close=True)
-
-                        # Add text label to DXF
-                        new_msp.add_text(element_name,dxfattribs={
-                            'height': 0.25,
-                            'layer': "LABELS",
-                            'insert':(center[0], center[1])})
-
-
-
-            # Write to CSV
-            with open(output_csv, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(["element", "x", "y", "z", "perimeter", "center_x", "center_y"])
-                writer.writerows(results)
-
-            # Save DXF
-            new_doc.saveas(output_dxf)
-
-            print(f"Exported {len(results)} coordinates to CSV: {output_csv}")
-            print(f"Exported matching faces to DXF: {output_dxf}")
-
-        except Exception as e:
-            print(f"Error: {e}")
-
-    #if __name__ == "__main__":
-    # Get the current script's directory
-    script_dir = Path(__file__).resolve().parent
-
-    #INPUT
-    dxf_file = script_dir / "uploads" / "01_shapes_foundation_all_.dxf"
-    #OUTPUT
-    output_csv = script_dir / "shared" / "01_Aug25-2D_SOPs_From_CAD.csv"
-    output_csv_filter = script_dir / "shared" / "01_Aug25-2D_SOPs_From_CAD_F_.csv"
-    output_dxf = script_dir / "shared" / "01_Aug25-2D_SOPs_From_CAD.dxf"
-
-    #RUN
-    process_and_export(dxf_file, output_csv, output_dxf)
-
-    ###################################################################
-    # Convert CSV to Excel
-    output_excel = output_csv.with_suffix('.xlsx')
-    df = pd.read_csv(output_csv)
-    df.to_excel(output_excel, index=False)
-
-    #FILTER data and convert to xlsx
-    # Define output Excel path (same name, .xlsx extension)
-    output_excel = output_csv_filter.with_suffix('.xlsx')
+logger = get_logger(__name__)
+
+# Columns of the vertex rows extracted from the GA 3DFACEs
+SOPS_COLUMNS = ["element", "x", "y", "z", "perimeter", "center_x", "center_y"]
+
+
+# Perimeter band of the foundation 3DFACEs
+PERIMETER_MIN = 5.9
+PERIMETER_MAX = 6.1
+
+# Entities ezdxf links to their parent instead of adding them to the modelspace
+LINKED_TYPES = {"VERTEX", "SEQEND", "ATTRIB"}
+
+
+def read_3dfaces(file_path):
+    """Loads the whole DXF document. Returns (modelspace index, vertices (n, 4, 3)) of the 3DFACEs"""
+    doc = ezdxf.readfile(file_path)
+    msp = doc.modelspace()
+
+    indices = []
+    vertices = []
+    for index, entity in enumerate(msp):
+        if entity.dxftype() == "3DFACE":
+            indices.append(index)
+            vertices.append([entity.dxf.vtx0, entity.dxf.vtx1, entity.dxf.vtx2, entity.dxf.vtx3])
+    return np.array(indices, dtype=np.int64), np.array(vertices, dtype=float).reshape(-1, 4, 3)
+
+
+def stream_3dfaces(file_path):
+    """Reads the ENTITIES section tag by tag without building the DXF document (ASCII DXF only).
+    Returns the same (modelspace index, vertices (n, 4, 3)) as read_3dfaces."""
+    indices = []
+    vertices = []
+    with open(file_path, mode="rt", encoding="utf-8", errors="surrogateescape") as fp:
+        in_entities = False
+        section_start = False
+        index = 0
+        entity_type = None
+        paperspace = False
+        coords = None
+
+        while True:
+            code = fp.readline()
+            value = fp.readline()
+            if not value:
+                break
+            code = int(code)
+            value = value.strip()
+
+            if code == 0:
+                # Close the previous entity
+                if entity_type is not None and not paperspace:
+                    if entity_type == "3DFACE":
+                        indices.append(index)
+                        vertices.append(coords)
+                    index += 1
+                entity_type = None
+                paperspace = False
+
+                if in_entities:
+                    if value == "ENDSEC":
+                        break
+                    if value not in LINKED_TYPES:
+                        entity_type = value
+                        coords = [0.0] * 12 if value == "3DFACE" else None
+                section_start = value == "SECTION"
+            elif code == 2 and section_start:
+                in_entities = value == "ENTITIES"
+                section_start = False
+            elif entity_type is not None:
+                if code == 67:
+                    paperspace = int(value) == 1
+                elif coords is not None and 10 <= code <= 33 and code % 10 <= 3:
+                    # 10..13 x, 20..23 y, 30..33 z of vtx0..vtx3
+                    coords[(code % 10) * 3 + code // 10 - 1] = float(value)
+
+    return np.array(indices, dtype=np.int64), np.array(vertices, dtype=float).reshape(-1, 4, 3)
+
+
+def is_binary_dxf(file_path):
+    with open(file_path, "rb") as fp:
+        return fp.read(22) == b"AutoCAD Binary DXF\r\n\x1a\x00"
+
+
+def face_sops(indices, vertices, perimeter_band=(PERIMETER_MIN, PERIMETER_MAX)):
+    """Vectorized perimeter band filter. Returns one row per vertex (SOPS_COLUMNS) of the foundation faces"""
+    v0, v1, v2, v3 = vertices[:, 0], vertices[:, 1], vertices[:, 2], vertices[:, 3]
+    # Triangles repeat the third vertex as the fourth one
+    is_quad = np.any(v3 != v2, axis=1)
 
-    # Load CSV
-    df = pd.read_csv(output_csv)
+    def distance(p1, p2):
+        d = p2 - p1
+        return np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2 + d[:, 2] ** 2)
+
+    closing = np.where(is_quad[:, None], v3, v0)
+    perimeter = distance(v0, v1) + distance(v1, v2) + distance(v2, closing) + np.where(is_quad, distance(v3, v0), 0.0)
+    center = np.where(is_quad[:, None], v0 + v1 + v2 + v3, v0 + v1 + v2)[:, :2] / np.where(is_quad, 4, 3)[:, None]
+
+    keep = (perimeter >= perimeter_band[0]) & (perimeter <= perimeter_band[1])
+    indices, vertices, is_quad = indices[keep], vertices[keep], is_quad[keep]
+    perimeter, center = perimeter[keep], np.round(center[keep], 3)
+
+    # One row per vertex, 3 for triangles and 4 for quads
+    vertex_mask = np.ones((len(indices), 4), dtype=bool)
+    vertex_mask[:, 3] = is_quad
+    face = np.repeat(np.arange(len(indices)), vertex_mask.sum(axis=1))
+    points = np.round(vertices[vertex_mask], 3)
+
+    return pd.DataFrame({
+        "element": pd.Series(indices[face]).map("3DFACE_{}".format),
+        "x": points[:, 0],
+        "y": points[:, 1],
+        "z": points[:, 2],
+        "perimeter": np.round(perimeter[face], 3),
+        "center_x": center[face, 0],
+        "center_y": center[face, 1],
+    }, columns=SOPS_COLUMNS)
+
+
+def export_dxf(sops_df, output_dxf):
+    # New DXF output
+    new_doc = ezdxf.new(dxfversion='R2010')
+    new_msp = new_doc.modelspace()
+
+    for element_name, face in sops_df.groupby("element", sort=False):
+        # Add polyline to DXF
+        poly_points = list(zip(face["x"], face["y"]))
+        poly_points.append(poly_points[0])  # close it
+        new_msp.add_lwpolyline(poly_points, close=True)
+
+        # Add text label to DXF
+        new_msp.add_text(element_name, dxfattribs={
+            'height': 0.25,
+            'layer': "LABELS",
+            'insert': (face["center_x"].iat[0], face["center_y"].iat[0])})
+
+    new_doc.saveas(output_dxf)
+    logger.info(f"Exported matching faces to DXF: {output_dxf}")
+
+
+def extract_3dfaces(file_path, streaming=True):
+    """{indices, vertices} of the 3DFACEs (dxfcache entry)"""
+    if streaming and not is_binary_dxf(file_path):
+        indices, vertices = stream_3dfaces(file_path)
+    else:
+        indices, vertices = read_3dfaces(file_path)
+    return {"indices": indices, "vertices": vertices}
+
+
+def process_and_export(file_path, output_dxf=None, streaming=True, perimeter_band=(PERIMETER_MIN, PERIMETER_MAX), entity_cache=None):
+    """Returns one row per 3DFACE vertex (SOPS_COLUMNS) for faces within the foundation perimeter band.
+    streaming reads only the 3DFACE tags instead of loading the whole document.
+    entity_cache is the dxfcache folder, the 3DFACEs of a file already seen are not parsed again."""
+    faces = dxfcache.load(file_path, "3dfaces", lambda path: extract_3dfaces(path, streaming), entity_cache)
+    indices, vertices = faces["indices"], faces["vertices"]
+    sops_df = face_sops(indices, vertices, perimeter_band)
+    sops_df.attrs["faces_scanned"] = len(indices)  # for the run stats
+    if sops_df.empty:
+        # the later steps would only produce empty deliverables
+        raise ValueError(f"No 3DFACE with a perimeter in {perimeter_band} among the {len(indices)} 3DFACEs of {Path(file_path).name}")
+
+    # Save DXF
+    if output_dxf is not None:
+        export_dxf(sops_df, output_dxf)
+
+    logger.info(f"Extracted {len(sops_df)} coordinates from {len(indices)} 3DFACEs in: {file_path}")
+    return sops_df
+
+
+def filter_sops(sops_df, default_z_value=81500):
+    """One row per foundation: element, Level (mm), Easting OS, Northing OS"""
+    df = sops_df.copy()
 
     # Set z column to default value
-    default_z_value = 81500  # You can change this as needed
     df['z'] = default_z_value
 
     # Drop duplicates based on center_x and center_y
@@ -123,12 +193,37 @@ def main():
         'z': 'Level (mm)'
     })
 
-    # Save to Excel
-    filtered_df=filtered_df.drop(columns=['x','y','perimeter'])
-    filtered_df.to_excel(output_excel, index=False)
+    filtered_df = filtered_df.drop(columns=['x', 'y', 'perimeter'])
+    return filtered_df.reset_index(drop=True)
 
-    print(f"Filtered and renamed Excel file saved to: {output_excel}")
 
-def display():
-    print("Automation Started")
+def run(dxf_file, output_dxf=None, debug_dir=None, streaming=True, perimeter_band=(PERIMETER_MIN, PERIMETER_MAX), level=81500,
+        entity_cache=None):
+    """Step 1: returns (sops_df, foundations_df). Intermediates are only written when debug_dir is given."""
+    sops_df = process_and_export(dxf_file, output_dxf, streaming=streaming, perimeter_band=perimeter_band,
+                                 entity_cache=entity_cache)
+    foundations_df = filter_sops(sops_df, default_z_value=level)
 
+    if debug_dir is not None:
+        output_table = write_table(sops_df, table_path(debug_dir, "01_Aug25-2D_SOPs_From_CAD"))
+        logger.info(f"SOPs table saved to: {output_table}")
+        output_table = write_table(foundations_df, table_path(debug_dir, "01_Aug25-2D_SOPs_From_CAD_F_"))
+        logger.info(f"Filtered and renamed table saved to: {output_table}")
+
+    return sops_df, foundations_df
+
+
+def main(workspace=None):
+    # Run folders, the legacy uploads/ shared/ downloads/ next to the scripts by default
+    workspace = workspace or Workspace.default()
+
+    #INPUT
+    dxf_file = workspace.uploads / "01_shapes_foundation_all_.dxf"
+    #OUTPUT
+    output_dxf = workspace.shared / "01_Aug25-2D_SOPs_From_CAD.dxf"
+
+    #RUN
+    return run(dxf_file, output_dxf, debug_dir=workspace.shared)
+
+def display():
+    logger.info("Automation Started")
@@ -1,136 +1,249 @@
+import logging
 import ezdxf
+import numpy as np
 import pandas as pd
-from shapely.geometry import LineString, Point
-from pathlib import Path
+import shapely
+from shapely.geometry import LineString
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import read_table, table_path, write_table
+import dxfcache
 from collections import defaultdict
 
-def main():
-    def list_filtered_entities(file_path, excel_path, output_excel_path, output_dxf_path, radius=2):
-        try:
-            # Load the DXF file
-            doc = ezdxf.readfile(file_path)
-            msp = doc.modelspace()
-
-            # Read Excel file and extract X, Y coordinates
-            df = pd.read_excel(excel_path, usecols=["Easting OS", "Northing OS", "Level (mm)"])
-            points = [Point(x, y) for x, y in zip(df["Easting OS"], df["Northing OS"])]
-
-            # Dictionary to store polylines and lines grouped by layer
-            layer_lines = {}
-
-            # Iterate through all entities in modelspace
-            for entity in msp:
-                layer = entity.dxf.layer
-
-                # Check if layer name starts with "Bus_P1_" or "Bus_P2_" (Priority to Bus_P1_)
-                #if layer.startswith("Bus_P1_") or layer.startswith("Bus_P2_"):
-                entity_type = entity.dxftype()
-
-                # If entity is LWPOLYLINE or LINE, extract vertex points
-                if entity_type == "LWPOLYLINE":
-                    vertices = [tuple(vertex[:2]) for vertex in entity.get_points()]
-                elif entity_type == "LINE":
-                    vertices = [(entity.dxf.start.x, entity.dxf.start.y), (entity.dxf.end.x, entity.dxf.end.y)]
-                else:
-                    continue
-
-                polyline = LineString(vertices)
-                if layer not in layer_lines:
-                    layer_lines[layer] = []
-                layer_lines[layer].append(polyline)
-                print(f"Layer: {layer}, Polyline/Line Length: {polyline.length:.2f}")
-
-            # Prioritize Bus_P1_ layers first
-            #sorted_layers = sorted(layer_lines.keys(), key=lambda x: (not x.startswith("Bus_P1_"), x))
-
-            # Create a new DXF document for point labels
-            text_doc = ezdxf.new()
-            text_msp = text_doc.modelspace()
-
-            # Assign points to the nearest line within the specified radius and order them along the line
-            assigned_points = set()  # To track used points
-
-            # Dictionary to store point data for Excel export
-            line_point_data = {}
-
-            #for layer in sorted_layers:
-            for layer in layer_lines:
-                line_count = 1  # Reset line numbering for each layer
-                for line in layer_lines[layer]:
-                    available_points = [p for p in points if (p.x, p.y) not in assigned_points]  # Exclude used points
-
-                    for point in available_points:
-                        nearest_distance = line.distance(point)
-
-                        if nearest_distance <= radius:
-                            projected_distance = line.project(point)
-                            print(projected_distance)
-                            short_layer_name = layer.replace("Bus_P1_", "").replace("Bus_P2_", "")
-                            line_name = f"{short_layer_name}_L{line_count}"
-                            if line_name not in line_point_data:
-                                line_point_data[line_name] = []
-                            level = df.loc[(df["Easting OS"] == point.x) & (df["Northing OS"] == point.y), "Level (mm)"].values
-                            id_value = df.loc[(df["Easting OS"] == point.x) & (df["Northing OS"] == point.y)].values
-                            level = level[0] if len(level) > 0 else None
-                            id_value = id_value[0] if len(id_value) > 0 else None
-                            line_point_data[line_name].append((layer, line_name, point.x, point.y, projected_distance, level, id_value))
-                            assigned_points.add((point.x, point.y))  # Mark point as used
-
-                    line_count += 1  # Increment line count for the next line in the same layer
-
-            # Export each set of points to a separate sheet in an Excel file, sorted by projected distance
-            with pd.ExcelWriter(output_excel_path) as writer:
-                if not line_point_data:  # Ensure at least one sheet exists
-                    pd.DataFrame({"Message": ["No points assigned to any lines."]}).to_excel(writer, sheet_name="No Data", index=False)
-                else:
-                    for line_name, points in line_point_data.items():
-                        if points:  # Only write sheets with points
-                            points.sort(key=lambda p: p[4])  # Sort by projected distance
-                            point_data = [(f"{p[0].replace('Bus_P1_', '').replace('Bus_P2_', '')}_L{p[1][-1]}P{i+1}", p[2], p[3], p[5], p[6]) for i, p in enumerate(points)]
-                            line_df = pd.DataFrame(point_data, columns=["Point Name", "X", "Y", "Level (mm)", "Extra"])
-                            line_df = line_df.drop(columns=["Extra"])
-                            line_df.to_excel(writer, sheet_name=line_name, index=False)
-
-                            # Add text labels to DXF
-                            for name, x, y, _, _ in point_data:
-                                text_msp.add_text(name, dxfattribs={"height": 0.25, "insert": (x, y, 0)})
-
-            # Save the DXF file with text labels
-            text_doc.saveas(output_dxf_path)
-            print(f"Points assigned and saved to: {output_excel_path}")
-            print(f"DXF file with point labels saved to: {output_dxf_path}")
-
-        except Exception as e:
-            print(f"Error: {e}")
+logger = get_logger(__name__)
+
+# Columns of the combined lanes table handed to step 4
+NAMES_COLUMNS = ["CIRCUIT REF", "FOUNDATION REF", "EASTING (mm)", "NORTHING (mm)", "FOUNDATION (T.O.C)"]
+
+
+def assign_points(lines, xs, ys, radius=2, assignment="first"):
+    """Bulk point-to-line assignment within radius.
+
+    assignment="first" gives each point to the first line (in drawing order) within radius,
+    as the original line by line scan did; "nearest" gives it to the closest line within radius.
+    Returns (line_idx, point_idx, projected_distance) arrays ordered by line then point.
+    """
+    if assignment not in ("first", "nearest"):
+        raise ValueError(f"Unknown assignment mode: {assignment}")
+    points = shapely.points(xs, ys)
+    if len(lines) == 0 or len(points) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float)
+
+    # Candidate (line, point) pairs within radius
+    tree = shapely.STRtree(points)
+    line_idx, point_idx = tree.query(lines, predicate="dwithin", distance=radius)
+    distances = shapely.distance(lines[line_idx], points[point_idx])
+    keep = distances <= radius
+    line_idx, point_idx, distances = line_idx[keep], point_idx[keep], distances[keep]
+    if len(point_idx) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float)
+
+    # Keep one line per point
+    if assignment == "first":
+        order = np.lexsort((line_idx, point_idx))
+    else:
+        order = np.lexsort((line_idx, distances, point_idx))
+    line_idx, point_idx = line_idx[order], point_idx[order]
+    first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+    line_idx, point_idx = line_idx[first], point_idx[first]
+
+    order = np.lexsort((point_idx, line_idx))
+    line_idx, point_idx = line_idx[order], point_idx[order]
+    projected = shapely.line_locate_point(lines[line_idx], points[point_idx])
+    return line_idx, point_idx, projected
+
+
+def assign_points_incremental(previous, lines, line_layers, xs, ys, radius=2, assignment="first"):
+    """Same result as assign_points, reusing the assignment of an earlier run (previous lane state)
+    for the points away from added/removed lanes. Returns (line_idx, point_idx, projected, recomputed points)."""
+    def full():
+        return (*assign_points(lines, xs, ys, radius, assignment), len(xs))
+
+    if previous is None or previous["radius"] != radius or previous["assignment"] != assignment:
+        return full()
+
+    # Lanes matched on layer + geometry (n-th copy of a duplicate matches the n-th copy)
+    old_index = {}
+    for i, key in enumerate(zip(previous["layers"], previous["wkb"])):
+        old_index.setdefault(key, []).append(i)
+    new_to_old = np.array([old_index[key].pop(0) if old_index.get(key) else -1
+                           for key in zip(line_layers, shapely.to_wkb(lines))], dtype=np.int64)
+    kept = new_to_old[new_to_old >= 0]
+    # "first" depends on the drawing order, it must be unchanged for the kept lanes
+    if np.any(np.diff(kept) <= 0):
+        return full()
+    old_to_new = np.full(len(previous["layers"]), -1, dtype=np.int64)
+    old_to_new[kept] = np.flatnonzero(new_to_old >= 0)
+
+    # Points matched on coordinates
+    old_points = {xy: i for i, xy in enumerate(zip(previous["xs"], previous["ys"]))}
+    point_to_old = np.array([old_points.get(xy, -1) for xy in zip(xs, ys)], dtype=np.int64)
+    old_line_of_point = np.full(len(previous["xs"]), -1, dtype=np.int64)
+    old_line_of_point[previous["point_idx"]] = previous["line_idx"]
+    old_projected = np.zeros(len(previous["xs"]))
+    old_projected[previous["point_idx"]] = previous["projected"]
+
+    # Affected: new points and points within radius of an added or removed lane
+    changed = np.concatenate([lines[new_to_old < 0], shapely.from_wkb(np.asarray(previous["wkb"], dtype=object)[old_to_new < 0])])
+    affected = point_to_old < 0
+    if len(changed) and len(xs):
+        _, near = shapely.STRtree(shapely.points(xs, ys)).query(changed, predicate="dwithin", distance=radius)
+        affected[near] = True
+
+    # Unaffected points keep their lane (renumbered) and distance along it
+    reused = np.flatnonzero(~affected)
+    reused_line = old_line_of_point[point_to_old[reused]]
+    on_line = reused_line >= 0
+    reused, reused_line = reused[on_line], old_to_new[reused_line[on_line]]
+    reused_projected = old_projected[point_to_old[reused]]
+
+    recomputed = np.flatnonzero(affected)
+    line_idx, point_idx, projected = assign_points(lines, xs[recomputed], ys[recomputed], radius, assignment)
+    line_idx = np.concatenate([reused_line, line_idx])
+    point_idx = np.concatenate([reused, recomputed[point_idx]])
+    projected = np.concatenate([reused_projected, projected])
+
+    order = np.lexsort((point_idx, line_idx))
+    return line_idx[order], point_idx[order], projected[order], len(recomputed)
+
+
+def extract_lanes(file_path):
+    """{vertices, offsets, layer_ids, layer_names} of the LWPOLYLINEs and LINEs in drawing order (dxfcache entry)"""
+    # Load the DXF file
+    doc = ezdxf.readfile(file_path)
+    msp = doc.modelspace()
+
+    lines = []
+    layer_ids = []
+    layer_names = {}
+
+    # Iterate through all entities in modelspace
+    for entity in msp:
+        layer = entity.dxf.layer
+
+        # Check if layer name starts with "Bus_P1_" or "Bus_P2_" (Priority to Bus_P1_)
+        #if layer.startswith("Bus_P1_") or layer.startswith("Bus_P2_"):
+        entity_type = entity.dxftype()
+
+        # If entity is LWPOLYLINE or LINE, extract vertex points
+        if entity_type == "LWPOLYLINE":
+            vertices = [tuple(vertex[:2]) for vertex in entity.get_points()]
+        elif entity_type == "LINE":
+            vertices = [(entity.dxf.start.x, entity.dxf.start.y), (entity.dxf.end.x, entity.dxf.end.y)]
+        else:
+            continue
+        lines.append(vertices)
+        layer_ids.append(layer_names.setdefault(layer, len(layer_names)))
+
+    vertices, offsets = dxfcache.pack_lines(lines)
+    return {"vertices": vertices, "offsets": offsets, "layer_ids": np.array(layer_ids, dtype=np.int32),
+            "layer_names": list(layer_names)}
 
-    #### Start Model
-    # Get the current script's directory
-    script_dir = Path(__file__).resolve().parent
-    #INPUT DATA
-    dxf_file = script_dir / "uploads" / "02_Aug25_busbarlanes.dxf"
-    excel_path = script_dir / "shared" / "01_Aug25-2D_SOPs_From_CAD_F_.xlsx"
-    #OUTPUT DATA
-    output_excel_path = script_dir / "shared" / "02_Aug25-Names_From_2D_SOPs.xlsx"
-    output_dxf_path = script_dir / "shared" / "02_Aug25-Names_From_2D_SOPs.dxf"
-    #RUN SCRIPT
-    list_filtered_entities(dxf_file, excel_path, output_excel_path, output_dxf_path, radius=2)
 
-    ###########################################################################################
-    ###########################################################################################
-    ### Creat and sort optional spread sheets formats
-    output_combined_path = script_dir / "shared" / "02_Aug25-Names_From_2D_SOPs_Comb_1.xlsx"
+def read_lanes(file_path, entity_cache=None):
+    """Busbar lane lines in drawing order, grouped by layer. Returns (lines, line names, line layers).
+    entity_cache is the dxfcache folder, the lanes of a file already seen are not parsed again."""
+    entities = dxfcache.load(file_path, "lanes", extract_lanes, entity_cache)
+    vertices, offsets = entities["vertices"], entities["offsets"]
 
-    # Load all sheet names
-    xls = pd.ExcelFile(output_excel_path)
-    sheet_names = xls.sheet_names
+    # Dictionary to store polylines and lines grouped by layer
+    layer_lines = {}
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    # Group sheets by prefix
+    for i, layer_id in enumerate(entities["layer_ids"]):
+        layer = entities["layer_names"][layer_id]
+        polyline = LineString(vertices[offsets[i]:offsets[i + 1]])
+        if layer not in layer_lines:
+            layer_lines[layer] = []
+        layer_lines[layer].append(polyline)
+        if debug:
+            logger.debug(f"Layer: {layer}, Polyline/Line Length: {polyline.length:.2f}")
+    logger.info(f"Read {len(offsets) - 1} busbar lane lines on {len(layer_lines)} layers")
+
+    # Prioritize Bus_P1_ layers first
+    #sorted_layers = sorted(layer_lines.keys(), key=lambda x: (not x.startswith("Bus_P1_"), x))
+
+    # Flatten lines in drawing order, numbering them per layer
+    lines = []
+    line_names = []
+    line_layers = []
+    #for layer in sorted_layers:
+    for layer in layer_lines:
+        short_layer_name = layer.replace("Bus_P1_", "").replace("Bus_P2_", "")
+        for line_count, line in enumerate(layer_lines[layer], 1):
+            lines.append(line)
+            line_names.append(f"{short_layer_name}_L{line_count}")
+            line_layers.append(layer)
+    return np.array(lines, dtype=object), line_names, line_layers
+
+
+def list_filtered_entities(file_path, foundations_df, output_dxf_path=None, radius=2, assignment="first", previous=None, state=None,
+                           entity_cache=None):
+    """Assigns foundation centers to busbar lanes. Returns {line_name: DataFrame} ordered along each line.
+
+    previous is the lane state of an earlier run (only points near changed lanes are reassigned),
+    state is filled with the lane state of this run.
+    """
+    line_tables = {}
+    lines, line_names, line_layers = read_lanes(file_path, entity_cache)
+
+    # X, Y coordinates and level of each foundation center
+    xs = foundations_df["Easting OS"].to_numpy(dtype=float)
+    ys = foundations_df["Northing OS"].to_numpy(dtype=float)
+    levels = foundations_df["Level (mm)"].to_numpy()
+
+    # New DXF document for point labels, only when it's saved
+    text_doc = ezdxf.new() if output_dxf_path is not None else None
+
+    # Assign points to a line within the specified radius and order them along the line
+    line_idx, point_idx, projected, recomputed = assign_points_incremental(
+        previous, lines, line_layers, xs, ys, radius, assignment)
+    if state is not None:
+        state.update({
+            "radius": radius, "assignment": assignment, "names": line_names, "layers": line_layers,
+            "wkb": list(shapely.to_wkb(lines)), "xs": xs, "ys": ys,
+            "line_idx": line_idx, "point_idx": point_idx, "projected": projected, "recomputed": recomputed,
+        })
+
+    # Dictionary to store point data per line
+    line_point_data = {}
+    for li, pi, projected_distance in zip(line_idx, point_idx, projected):
+        line_name = line_names[li]
+        if line_name not in line_point_data:
+            line_point_data[line_name] = []
+        line_point_data[line_name].append((line_layers[li], line_name, xs[pi], ys[pi], projected_distance, levels[pi]))
+
+    # One table per line, sorted by projected distance
+    for line_name, line_points in line_point_data.items():
+        if line_points:
+            line_points.sort(key=lambda p: p[4])  # Sort by projected distance
+            point_data = [(f"{p[0].replace('Bus_P1_', '').replace('Bus_P2_', '')}_L{p[1][-1]}P{i+1}", p[2], p[3], p[5]) for i, p in enumerate(line_points)]
+            line_tables[line_name] = pd.DataFrame(point_data, columns=["Point Name", "X", "Y", "Level (mm)"])
+
+            # Add text labels to DXF
+            if text_doc is not None:
+                text_msp = text_doc.modelspace()
+                for name, x, y, _ in point_data:
+                    text_msp.add_text(name, dxfattribs={"height": 0.25, "insert": (x, y, 0)})
+
+    # Save the DXF file with text labels
+    if text_doc is not None:
+        text_doc.saveas(output_dxf_path)
+        logger.info(f"DXF file with point labels saved to: {output_dxf_path}")
+    logger.info(f"Points assigned to {len(line_tables)} lines ({recomputed} of {len(xs)} points recomputed)")
+
+    return line_tables
+
+
+def combine_lanes(line_tables):
+    """Groups the _L1/_L2/_L3 lines of each lane into one table per CIRCUIT REF"""
+    # Group lines by prefix
     prefix_groups = defaultdict(dict)
 
-    for sheet in sheet_names:
-        if sheet.endswith(('_L1', '_L2', '_L3')):
-            prefix, suffix = sheet.rsplit('_', 1)
-            prefix_groups[prefix][suffix] = sheet
+    for line_name in line_tables:
+        if line_name.endswith(('_L1', '_L2', '_L3')):
+            prefix, suffix = line_name.rsplit('_', 1)
+            prefix_groups[prefix][suffix] = line_name
 
     # Rename map
     rename_map = {
@@ -141,26 +254,56 @@ def main():
     }
 
     # Sort and combine
-    with pd.ExcelWriter(output_combined_path, engine='openpyxl') as writer:
-        for prefix, parts in prefix_groups.items():
-            combined_df = pd.DataFrame()
-            for suffix in ['L1', 'L2', 'L3']:
-                sheetname = parts.get(suffix)
-                if sheetname:
-                    df = pd.read_excel(xls, sheet_name=sheetname)
-                    df = df.rename(columns=rename_map)
-                    df["CIRCUIT REF"] = prefix  # ➕ add column here
-                    cols = ["CIRCUIT REF"] + [col for col in df.columns if col != "CIRCUIT REF"]
-                    df = df[cols]
-                    combined_df = pd.concat([combined_df, df], ignore_index=True)
-
-            combined_df.to_excel(writer, sheet_name=prefix, index=False)
-
-    print(f"✅ Combined sheets saved to {output_combined_path}")
-
-    # Combine in one sheet
-    output_combined_path2 = script_dir / "shared" / "02_Aug25-Names_From_2D_SOPs_Comb_2.xlsx"
-    all_sheets = pd.read_excel(output_combined_path, sheet_name=None)
-    combined_df = pd.concat(all_sheets.values(), ignore_index=True)
-    combined_df.to_excel(output_combined_path2, index=False)
-    print(f"✅ Combined sheet saved to: {output_combined_path2}")
+    lane_tables = {}
+    for prefix, parts in prefix_groups.items():
+        frames = []
+        for suffix in ['L1', 'L2', 'L3']:
+            line_name = parts.get(suffix)
+            if line_name:
+                df = line_tables[line_name].rename(columns=rename_map)
+                df.insert(0, "CIRCUIT REF", prefix)
+                frames.append(df)
+        lane_tables[prefix] = pd.concat(frames, ignore_index=True)
+
+    return lane_tables
+
+
+def run(dxf_file, foundations_df, output_dxf_path=None, debug_dir=None, radius=2, assignment="first", previous=None, state=None,
+        entity_cache=None):
+    """Step 2: returns the combined lanes table (NAMES_COLUMNS). Intermediates are only written when debug_dir is given.
+    previous / state: lane state of an earlier run / dict filled with this run's one (incremental runs)."""
+    line_tables = list_filtered_entities(dxf_file, foundations_df, output_dxf_path, radius=radius, assignment=assignment,
+                                         previous=previous, state=state, entity_cache=entity_cache)
+    lane_tables = combine_lanes(line_tables)
+    if lane_tables:
+        names_df = pd.concat(lane_tables.values(), ignore_index=True)
+    else:
+        names_df = pd.DataFrame(columns=NAMES_COLUMNS)
+
+    if debug_dir is not None:
+        # One table for all lines (the former sheet per line is the Line column)
+        lines_df = pd.concat([line_df.assign(Line=line_name) for line_name, line_df in line_tables.items()], ignore_index=True) \
+            if line_tables else pd.DataFrame(columns=["Point Name", "X", "Y", "Level (mm)", "Line"])
+        output_lines_path = write_table(lines_df[["Line", "Point Name", "X", "Y", "Level (mm)"]],
+                                        table_path(debug_dir, "02_Aug25-Names_From_2D_SOPs"))
+        logger.info(f"Points assigned and saved to: {output_lines_path}")
+
+        # Comb_2 holds the former per circuit Comb_1 sheets (CIRCUIT REF column)
+        output_combined_path = write_table(names_df, table_path(debug_dir, "02_Aug25-Names_From_2D_SOPs_Comb_2"))
+        logger.info(f"✅ Combined table saved to: {output_combined_path}")
+
+    return names_df
+
+
+def main(workspace=None):
+    #### Start Model
+    # Run folders, the legacy uploads/ shared/ downloads/ next to the scripts by default
+    workspace = workspace or Workspace.default()
+    #INPUT DATA
+    dxf_file = workspace.uploads / "02_Aug25_busbarlanes.dxf"
+    table = table_path(workspace.shared, "01_Aug25-2D_SOPs_From_CAD_F_")
+    foundations_df = read_table(table, columns=["Easting OS", "Northing OS", "Level (mm)"])
+    #OUTPUT DATA
+    output_dxf_path = workspace.shared / "02_Aug25-Names_From_2D_SOPs.dxf"
+    #RUN SCRIPT
+    return run(dxf_file, foundations_df, output_dxf_path, debug_dir=workspace.shared, radius=2)
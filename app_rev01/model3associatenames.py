@@ -1,123 +1,184 @@
-import csv
 import ezdxf
-from pathlib import Path
-import math
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import read_table, table_path, write_table
+import dxfcache
+import numpy as np
 import pandas as pd
-
-def main():
-    # Global list to collect all matched point data
-    matched_points = []
-
-    def load_csv_centers(csv_filename):
-        centers = []
-        with open(csv_filename, mode='r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                x = float(row['center_x'])
-                y = float(row['center_y'])
-                centers.append((x, y))
-        return centers
-
-    def is_within_radius(pt1, pt2, radius=2.0):
-        return math.dist(pt1, pt2) <= radius
-
-    def filter_text_entities(input_dxf, centers, output_dxf):
-        doc = ezdxf.readfile(input_dxf)
-        msp = doc.modelspace()
-        Z = 81500  # Constant level
-
+from scipy.spatial import cKDTree
+
+logger = get_logger(__name__)
+
+# Columns of the associated names table handed to step 4
+NAMES_COLUMNS = ["FOUNDATION REF", "EASTING (mm)", "NORTHING (mm)", "FOUNDATION (T.O.C)"]
+
+# Rename map
+rename_map = {
+    "Point Name": "FOUNDATION REF",
+    "X": "EASTING (mm)",
+    "Y": "NORTHING (mm)",
+    "Level (mm)": "FOUNDATION (T.O.C)"
+}
+
+
+def load_centers(sops_df):
+    """Unique foundation centers in first seen order (sops_df has one row per vertex)"""
+    centers = sops_df[['center_x', 'center_y']].astype(float).drop_duplicates()
+    return centers.to_numpy()
+
+
+def extract_texts(input_dxf, text_types=("MTEXT",)):
+    """{texts, layer_ids, layer_names, inserts} of the text_types entities in drawing order (dxfcache entry)"""
+    doc = ezdxf.readfile(input_dxf)
+    msp = doc.modelspace()
+
+    texts = []
+    layer_ids = []
+    layer_names = {}
+    inserts = []
+    for entity in msp:
+        if entity.dxftype() not in text_types:
+            continue
+        # MTEXT dxf.text is the whole content, same as entity.text
+        insert = entity.dxf.insert
+        texts.append(entity.dxf.text)
+        layer_ids.append(layer_names.setdefault(entity.dxf.layer, len(layer_names)))
+        inserts.append((insert[0], insert[1]))
+
+    return {"texts": texts, "layer_ids": np.array(layer_ids, dtype=np.int32), "layer_names": list(layer_names),
+            "inserts": np.array(inserts, dtype=float).reshape(-1, 2)}
+
+
+def read_text_inserts(input_dxf, text_types=("MTEXT",), prefix="F", entity_cache=None):
+    """Returns (texts, layers, insert points) of the text entities whose content starts with prefix.
+    entity_cache is the dxfcache folder, the texts of a file already seen are not parsed again."""
+    kind = "texts-" + "-".join(sorted(text_types))
+    entities = dxfcache.load(input_dxf, kind, lambda path: extract_texts(path, text_types), entity_cache)
+
+    # Filter for text starting with the foundation ID prefix
+    keep = [i for i, text in enumerate(entities["texts"]) if text.startswith(prefix)]
+    texts = [entities["texts"][i] for i in keep]
+    layers = [entities["layer_names"][entities["layer_ids"][i]] for i in keep]
+    return texts, layers, np.array(entities["inserts"][keep], dtype=float).reshape(-1, 2)
+
+
+def nearest_centers(inserts, centers, radius=2.0):
+    """Index of the first center within radius of each insert point, -1 when none"""
+    matches = np.full(len(inserts), -1, dtype=np.int64)
+    if len(inserts) == 0 or len(centers) == 0:
+        return matches
+
+    tree = cKDTree(centers)
+    for i, found in enumerate(tree.query_ball_point(inserts, r=radius, return_sorted=True)):
+        if found:
+            matches[i] = found[0]
+    return matches
+
+
+def nearest_centers_incremental(previous, keys, inserts, centers, radius=2.0):
+    """Same result as nearest_centers, reusing the matches of an earlier run (previous text state) for texts
+    with no added center within radius and whose center still exists. Returns (matches, recomputed texts)."""
+    def full():
+        return nearest_centers(inserts, centers, radius), len(inserts)
+
+    if previous is None or previous["radius"] != radius:
+        return full()
+
+    # Centers matched on coordinates, their first seen order must be unchanged
+    new_index = {xy: i for i, xy in enumerate(map(tuple, centers))}
+    old_to_new = np.array([new_index.get(xy, -1) for xy in map(tuple, previous["centers"])], dtype=np.int64)
+    kept = old_to_new[old_to_new >= 0]
+    if np.any(np.diff(kept) <= 0):
+        return full()
+    added = np.ones(len(centers), dtype=bool)
+    added[kept] = False
+
+    # Texts matched on (text, layer, insert)
+    old_texts = {key: i for i, key in enumerate(previous["keys"])}
+    text_to_old = np.array([old_texts.get(key, -1) for key in keys], dtype=np.int64)
+    old_match = np.full(len(keys), -1, dtype=np.int64)
+    old_match[text_to_old >= 0] = previous["matches"][text_to_old[text_to_old >= 0]]
+    reused_match = np.full(len(keys), -1, dtype=np.int64)
+    reused_match[old_match >= 0] = old_to_new[old_match[old_match >= 0]]
+
+    # Affected: new texts, texts whose center was removed and texts near an added center
+    affected = (text_to_old < 0) | ((old_match >= 0) & (reused_match < 0))
+    if added.any() and len(inserts):
+        near = cKDTree(centers[added]).query_ball_point(inserts, r=radius, return_length=True)
+        affected |= near > 0
+
+    matches = reused_match
+    recomputed = np.flatnonzero(affected)
+    matches[recomputed] = nearest_centers(inserts[recomputed], centers, radius)
+    return matches, len(recomputed)
+
+
+def filter_text_entities(input_dxf, centers, output_dxf=None, Z=81500, text_types=("MTEXT",), prefix="F", radius=2.0,
+                         previous=None, state=None, entity_cache=None):
+    """Returns the foundation ID texts snapped to the first center within radius (Point Name, X, Y, Level (mm)).
+    previous is the text state of an earlier run, state is filled with the one of this run."""
+    texts, layers, inserts = read_text_inserts(input_dxf, text_types, prefix, entity_cache)
+    keys = list(zip(texts, layers, map(tuple, inserts)))
+    matches, recomputed = nearest_centers_incremental(previous, keys, inserts, centers, radius)
+    if state is not None:
+        state.update({"radius": radius, "centers": centers, "keys": keys, "matches": matches, "recomputed": recomputed})
+    found = np.flatnonzero(matches >= 0)
+    matched_centers = centers[matches[found]] if len(found) else np.empty((0, 2))
+
+    matched_df = pd.DataFrame({
+        "Point Name": [texts[i] for i in found],
+        "X": matched_centers[:, 0],
+        "Y": matched_centers[:, 1],
+        "Level (mm)": Z,
+    }, columns=list(rename_map))
+    logger.info(f"Matched {len(matched_df)} of {len(texts)} '{prefix}' text entities to foundation centers ({recomputed} recomputed)")
+
+    if output_dxf is not None:
         # Create new DXF output
         new_doc = ezdxf.new(dxfversion='R2010')
         new_msp = new_doc.modelspace()
+        for i, (x, y) in zip(found, matched_centers):
+            new_msp.add_text(texts[i], dxfattribs={
+                'insert': (x, y),
+                'layer': layers[i],
+                'height': 0.35
+            })
+        new_doc.saveas(output_dxf)
+        logger.info(f"Exported {len(matched_df)} matching TEXT entities to: {output_dxf}")
 
-        count = 0
-        for entity in msp:
-            if entity.dxftype() == "MTEXT":
-                insert = entity.dxf.insert
-                text_point = (insert[0], insert[1])
-                text_content = entity.text
-
-                # Filter for text starting with letter F
-                if text_content.startswith("F"):
-                    print(f"Text Content: {text_content}")
-                    # Check if this text is within radius of any center
-                    # Find the first matching center within radius
-                    matching_center = next((center for center in centers if is_within_radius(text_point, center)), None)
-
-                    if matching_center:
-                        print("Found TXT inside radius!")
-                        print("Insert", insert)
-                        print("Center", matching_center)
-                        new_msp.add_text(entity.dxf.text, dxfattribs={
-                            'insert': matching_center,
-                            'layer': entity.dxf.layer,
-                            'height': 0.35
-                        })
-
-                        #store for xlxs data
-                        store_matched_point(entity.dxf.text, matching_center, Z)
-
-                        count += 1
+    return matched_df
 
 
+def run(dxf_input, sops_df, dxf_output=None, debug_dir=None, text_types=("MTEXT",), prefix="F", level=81500,
+        previous=None, state=None, entity_cache=None):
+    """Step 3: returns the associated names table (NAMES_COLUMNS). Intermediates are only written when debug_dir is given.
 
-        new_doc.saveas(output_dxf)
-        print(f"Exported {count} matching TEXT entities to: {output_dxf}")
+    text_types selects the DXF text entities to read (e.g. ("MTEXT", "TEXT")) and prefix the foundation ID filter.
+    previous / state: text state of an earlier run / dict filled with this run's one (incremental runs).
+    """
+    centers = load_centers(sops_df)
+    matched_df = filter_text_entities(dxf_input, centers, dxf_output, Z=level, text_types=text_types, prefix=prefix,
+                                      previous=previous, state=state, entity_cache=entity_cache)
+    names_df = matched_df.rename(columns=rename_map)
 
+    if debug_dir is not None:
+        table_output = write_table(matched_df, table_path(debug_dir, "03_Aug25-Associated_Foundation_Name_A"))
+        logger.info(f"Saved {len(matched_df)} points to {table_output}")
+        table_output2 = write_table(names_df, table_path(debug_dir, "03_Aug25-Associated_Foundation_Name_B"))
+        logger.info(f"✅ Renamed table saved to {table_output2}")
 
-    def store_matched_point(text, center, level):
-        """Store matched point data in a global list."""
-        x, y = center
-        matched_points.append({
-            "Point Name": text,
-            "X": x,
-            "Y": y,
-            "Level (mm)": level
-        })
+    return names_df
 
-    def export_to_excel(filename="output.xlsx"):
-        """Export matched points to an Excel file."""
-        df = pd.DataFrame(matched_points)
-        df.to_excel(filename, index=False)
-        print(f"Saved {len(matched_points)} points to {filename}")
 
+def main(workspace=None):
     ##############################################################################################
     #RUN APP
-    #if __name__ == "__main__":
-    script_dir = Path(__file__).resolve().parent
+    workspace = workspace or Workspace.default()
     #INPUT
-    #csv_file = script_dir / "input" / "CAD_foundations_sop.csv"
-    #file CSV below may require to be filtered by unique elements in the x & y axis
-    csv_file = script_dir / "shared" / "01_Aug25-2D_SOPs_From_CAD.csv"
-    dxf_input = script_dir / "uploads" / "03_Drawing_All_Text_Export.dxf"
+    sops_table = table_path(workspace.shared, "01_Aug25-2D_SOPs_From_CAD")
+    dxf_input = workspace.uploads / "03_Drawing_All_Text_Export.dxf"
     #OUTPUT
-    dxf_output = script_dir / "shared" / "03_Aug25-Associated_Foundation_Name.dxf"
-    excel_output = script_dir / "shared" / "03_Aug25-Associated_Foundation_Name_A.xlsx"
-
-    centers = load_csv_centers(csv_file)
-    filter_text_entities(dxf_input, centers, dxf_output)
-    export_to_excel(excel_output)
-
-    ##############################################################################################
-    # Rename Excel
-    excel_output2 = script_dir / "shared" / "03_Aug25-Associated_Foundation_Name_B.xlsx"
-
-    # Rename map
-    rename_map = {
-        "Point Name":"FOUNDATION REF",
-        "X": "EASTING (mm)",
-        "Y": "NORTHING (mm)",
-        "Level (mm)": "FOUNDATION (T.O.C)"
-    }
-
-    # Load and rename all sheets
-    xls = pd.ExcelFile(excel_output)
-
-    with pd.ExcelWriter(excel_output2, engine='openpyxl') as writer:
-        for sheet in xls.sheet_names:
-            df = pd.read_excel(xls, sheet_name=sheet)
-            df = df.rename(columns=rename_map)
-            df.to_excel(writer, sheet_name=sheet, index=False)
-
-    print(f"✅ Renamed sheets saved to {excel_output2}")
+    dxf_output = workspace.shared / "03_Aug25-Associated_Foundation_Name.dxf"
 
+    sops_df = read_table(sops_table)
+    return run(dxf_input, sops_df, dxf_output, debug_dir=workspace.shared)
@@ -1,28 +1,71 @@
+import numpy as np
 import pandas as pd
-import os
-from pathlib import Path
+from scipy.spatial import cKDTree
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import read_table, table_path, write_table
+
+logger = get_logger(__name__)
 
 ### THIS SCRIPT ################################################
 ### MATCHES Naming from string lines automation with data from #
-### client data extracted from CAD files (SOPs and Text)       # 
+### client data extracted from CAD files (SOPs and Text)       #
 ################################################################
 
-def main():
-    # Clear console
-    clear = lambda: os.system('cls')
-    clear()
-    
-    # File paths
-    script_dir = Path(__file__).resolve().parent
-    #INPUT
-    file1 = script_dir / "shared" / "02_Aug25-Names_From_2D_SOPs_Comb_2.xlsx"
-    file2 = script_dir / "shared" / "03_Aug25-Associated_Foundation_Name_B.xlsx"
-    #OUTPUT
-    output_file = script_dir / "shared" / "new_vs_old.xlsx"
+def snap_keys(values, decimals=2):
+    """Integer keys of coordinates rounded to decimals (NaN -> -1, check with the valid mask)"""
+    scaled = np.rint(np.asarray(values, dtype=float) * 10 ** decimals)
+    valid = ~np.isnan(scaled)
+    return np.where(valid, scaled, -1).astype(np.int64), valid
+
+
+def match_coordinates(e1, n1, e2, n2, tolerance=0, decimals=2):
+    """Position in (e2, n2) of the first unused point within tolerance of each (e1, n1), -1 when none.
+
+    Rows of (e1, n1) are served in order and each (e2, n2) point is used at most once.
+    tolerance=0 is an exact hash join on snapped integer keys, otherwise a KD-tree box query.
+    """
+    matches = np.full(len(e1), -1, dtype=np.int64)
+
+    if tolerance == 0:
+        ke1, valid_e1 = snap_keys(e1, decimals)
+        kn1, valid_n1 = snap_keys(n1, decimals)
+        ke2, valid_e2 = snap_keys(e2, decimals)
+        kn2, valid_n2 = snap_keys(n2, decimals)
+        left = pd.DataFrame({"e": ke1, "n": kn1, "pos1": np.arange(len(e1))})[valid_e1 & valid_n1]
+        right = pd.DataFrame({"e": ke2, "n": kn2, "pos2": np.arange(len(e2))})[valid_e2 & valid_n2]
+
+        # The k-th row with a given key takes the k-th unused point with the same key
+        left["rank"] = left.groupby(["e", "n"]).cumcount()
+        right["rank"] = right.groupby(["e", "n"]).cumcount()
+        joined = left.merge(right, on=["e", "n", "rank"], how="inner")
+        matches[joined["pos1"].to_numpy()] = joined["pos2"].to_numpy()
+        return matches
+
+    points1 = np.column_stack([e1, n1]).astype(float)
+    points2 = np.column_stack([e2, n2]).astype(float)
+    valid1 = ~np.isnan(points1).any(axis=1)
+    valid2 = np.flatnonzero(~np.isnan(points2).any(axis=1))
+    if len(valid2) == 0:
+        return matches
+
+    # Chebyshev distance (p=inf) matches the per axis abs() <= tolerance test
+    tree = cKDTree(points2[valid2])
+    candidates = tree.query_ball_point(points1[valid1], r=tolerance, p=np.inf, return_sorted=True)
+    used = np.zeros(len(valid2), dtype=bool)
+    for pos1, found in zip(np.flatnonzero(valid1), candidates):
+        for j in found:
+            if not used[j]:
+                used[j] = True
+                matches[pos1] = valid2[j]
+                break
+    return matches
+
 
-    # Load Excel files
-    df1 = pd.read_excel(file1)
-    df2 = pd.read_excel(file2)
+def match_names(df1, df2, tolerance=0):
+    """One row per df1 row, joined to the first unused df2 row at the same coordinates (Match Status MATCHED/NO MATCH)"""
+    df1 = df1.copy().reset_index(drop=True)
+    df2 = df2.copy().reset_index(drop=True)
 
     # Convert coordinates to float and round
     df1["EASTING (mm)"] = pd.to_numeric(df1["EASTING (mm)"], errors="coerce").round(2)
@@ -30,57 +73,47 @@ def main():
     df2["EASTING (mm)"] = pd.to_numeric(df2["EASTING (mm)"], errors="coerce").round(2)
     df2["NORTHING (mm)"] = pd.to_numeric(df2["NORTHING (mm)"], errors="coerce").round(2)
 
-    # Prepare output
-    output_rows = []
-    tolerance = 0
-    match_count = 0
-    no_match_count = 0
-
-    df2_used_indices = set()  # to track which rows in df2 have already matched
-
-    for _, row1 in df1.iterrows():
-        e1 = row1["EASTING (mm)"]
-        n1 = row1["NORTHING (mm)"]
-        matched = False
-
-        for index2, row2 in df2.iterrows():
-            if index2 in df2_used_indices:
-                continue  # Skip already matched rows
-
-            e2 = row2["EASTING (mm)"]
-            n2 = row2["NORTHING (mm)"]
-
-            if abs(e1 - e2) <= tolerance and abs(n1 - n2) <= tolerance:
-                # Combine all columns from both rows
-                #combined_data = {f"file1_{k}": v for k, v in row1.items()}
-                combined_data = {k: v for k, v in row1.items()}
-                combined_data.update({f"F2_{k}": v for k, v in row2.items()})
-                combined_data["Match Status"] = "MATCHED"
-                output_rows.append(combined_data)
-
-                df2_used_indices.add(index2)
-                match_count += 1
-                matched = True
-                break
-
-        if not matched:
-            #combined_data = {f"file1_{k}": v for k, v in row1.items()}
-            combined_data = {k: v for k, v in row1.items()}
-            # Add empty file2 columns
-            for col in df2.columns:
-                combined_data[f"F2_{col}"] = None
-            combined_data["Match Status"] = "NO MATCH"
-            output_rows.append(combined_data)
-            no_match_count += 1
+    matches = match_coordinates(
+        df1["EASTING (mm)"].to_numpy(), df1["NORTHING (mm)"].to_numpy(),
+        df2["EASTING (mm)"].to_numpy(), df2["NORTHING (mm)"].to_numpy(),
+        tolerance=tolerance)
+    matched = matches >= 0
 
-    # Convert to DataFrame and export
-    df_output = pd.DataFrame(output_rows)
-    df_output.to_excel(output_file, index=False)
+    # Combine all columns from both files, file2 columns are empty for unmatched rows
+    df2_matched = df2.reindex(np.where(matched, matches, -1)).reset_index(drop=True)
+    df2_matched.columns = [f"F2_{col}" for col in df2.columns]
+    df_output = pd.concat([df1, df2_matched], axis=1)
+    df_output["Match Status"] = np.where(matched, "MATCHED", "NO MATCH")
 
     # Summary
-    print(f"\n✅ Output saved to {output_file}")
-    print(f"\n🔍 Matching Summary:")
-    print(f"  Matches found     : {match_count}")
-    print(f"  No matches found  : {no_match_count}")
-    print("\n🎯 Process Complete.")
+    match_count = int(matched.sum())
+    logger.info(f"🔍 Matching Summary: {match_count} matches found, {len(matched) - match_count} no matches found")
+
+    return df_output
+
+
+def run(lanes_df, text_names_df, debug_dir=None, tolerance=0):
+    """Step 4.1: returns the new vs old names table. Intermediates are only written when debug_dir is given."""
+    df_output = match_names(lanes_df, text_names_df, tolerance=tolerance)
+
+    if debug_dir is not None:
+        output_file = write_table(df_output, table_path(debug_dir, "new_vs_old"))
+        logger.info(f"✅ Output saved to {output_file}")
+
+    return df_output
+
+
+def main(workspace=None):
+    # File paths
+    workspace = workspace or Workspace.default()
+    #INPUT
+    file1 = table_path(workspace.shared, "02_Aug25-Names_From_2D_SOPs_Comb_2")
+    file2 = table_path(workspace.shared, "03_Aug25-Associated_Foundation_Name_B")
+
+    # Load intermediate tables
+    df1 = read_table(file1)
+    df2 = read_table(file2)
 
+    df_output = run(df1, df2, debug_dir=workspace.shared)
+    logger.info("🎯 Process Complete.")
+    return df_output
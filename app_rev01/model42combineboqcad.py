@@ -1,20 +1,18 @@
 import pandas as pd
+import ezdxf
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import read_table, table_path, write_table
+from ingest import BOQ_SCHEMA, FOUNDATION_TYPES_SCHEMA, read_sheet
+
+logger = get_logger(__name__)
 ### THIS SCRIPT #########################################
 ### MATCHES step 1 data with client BOQ schedulled data #
 ### Adds design foundations types and sizes             #
 #########################################################
-def main():
-    # File paths
-    from pathlib import Path
-    script_dir = Path(__file__).resolve().parent
-    file1 = script_dir / "uploads" / "CAAR-BOQ.xlsx"
-    file2 = script_dir / "shared" / "new_vs_old.xlsx"
-    output_file = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD.xlsx"
-
-    # Load both Excel files
-    df1 = pd.read_excel(file1)
-    df2 = pd.read_excel(file2)
 
+def combine_boq(df1, df2, df_f_type):
+    """Merges the client BoQ (df1) with the new vs old names (df2) and the design foundation types"""
     # Rename file2's column temporarily to match df1 for merging
     df2_temp = df2.rename(columns={"FOUNDATION REF": "NEW_FOUNDATION REF"})
     df2_temp = df2_temp.rename(columns={"F2_FOUNDATION REF": "FOUNDATION REF"})
@@ -41,14 +39,9 @@ def main():
 
     #####################################################################################################################################
     # Associate with foundation types template
-    # Load the foundation type lookup table
-    f_type_file = script_dir / "uploads" / "04_Design_Foundations_Type.xlsx"
-    df_f_type = pd.read_excel(f_type_file)
+    df_f_type = df_f_type.copy()
     df_f_type.columns = df_f_type.columns.str.strip()  # Just in case
 
-    # Optional: check it's using the expected headers
-    # print(df_f_type.columns)
-
     # Merge with suffixes to handle duplicate column names
     merged_df = pd.merge(
         merged_df,
@@ -64,21 +57,13 @@ def main():
     # Drop the extra column
     merged_df.drop(columns=["FOUNDATION TYPE_new"], inplace=True)
 
+    # Categorical columns of the BoQ read (ingest.BOQ_SCHEMA) back to plain values for the later stages and deliverables
+    categorical = merged_df.select_dtypes("category").columns
+    merged_df[categorical] = merged_df[categorical].astype(object)
+    return merged_df
 
-    #####################################################################################################################################
-    # Save to Excel
-    merged_df.to_excel(output_file, index=False)
-
-    print(f"✅ {len(merged_df)} matching rows written to:\n{output_file}")
-
-    #####################################################################################################################################
-    # Create CAD QA DXF
-    import ezdxf
-    from pathlib import Path
-
-    # Path to save your DXF file
-    output_dxf = script_dir / "shared" / "04_CAD_QA_Step2.dxf"
 
+def write_qa_dxf(merged_df, output_dxf):
     # Create new DXF
     doc = ezdxf.new(dxfversion='R2010')
     msp = doc.modelspace()
@@ -111,4 +96,37 @@ def main():
 
     # Save DXF
     doc.saveas(output_dxf)
-    print(f"✅ DXF file saved to: {output_dxf}")
+    logger.info(f"✅ DXF file saved to: {output_dxf}")
+
+
+def run(boq_file, f_type_file, new_vs_old_df, output_dxf=None, debug_dir=None):
+    """Step 4.2: returns the BoQ rows matched with CAD SOPs and foundation types. Intermediates are only written when debug_dir is given."""
+    # Load client BoQ and the foundation type lookup table (schema columns only, typed)
+    df1 = read_sheet(boq_file, BOQ_SCHEMA)
+    df_f_type = read_sheet(f_type_file, FOUNDATION_TYPES_SCHEMA)
+
+    merged_df = combine_boq(df1, new_vs_old_df, df_f_type)
+    logger.info(f"✅ {len(merged_df)} matching rows")
+
+    if debug_dir is not None:
+        output_file = write_table(merged_df, table_path(debug_dir, "04_Aug25-BOQ_SOPs_from_CAD"))
+        logger.info(f"✅ {len(merged_df)} matching rows written to: {output_file}")
+
+    # Create CAD QA DXF
+    if output_dxf is not None:
+        write_qa_dxf(merged_df, output_dxf)
+
+    return merged_df
+
+
+def main(workspace=None):
+    # File paths
+    workspace = workspace or Workspace.default()
+    file1 = workspace.uploads / "CAAR-BOQ.xlsx"
+    file2 = table_path(workspace.shared, "new_vs_old")
+    f_type_file = workspace.uploads / "04_Design_Foundations_Type.xlsx"
+    # Path to save your DXF file
+    output_dxf = workspace.shared / "04_CAD_QA_Step2.dxf"
+
+    df2 = read_table(file2)
+    return run(file1, f_type_file, df2, output_dxf, debug_dir=workspace.shared)
@@ -1,82 +1,101 @@
-import pandas as pd
-import math
-import os
-from pathlib import Path
+import numpy as np
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import read_table, table_path, write_xlsx
+
+logger = get_logger(__name__)
 
 ### THIS SCRIPT ###################################
 ### Generates 4 coorners SOPs and sorts dataframe #
 ###################################################
-def main():
-    def corner_sops(EASTING_OS, NORTHING_OS, WIDTH):
-        WIDTH=(WIDTH/1000)/2
-        angle = math.radians(-127)  # Convert degrees to radians
-
-        # Calculate the corners relative to the center
-        corners = [
-            (WIDTH * math.cos(angle) - WIDTH * math.sin(angle), WIDTH * math.sin(angle) + WIDTH * math.cos(angle)),  # Top-right
-            (WIDTH * math.cos(angle) + WIDTH * math.sin(angle), WIDTH * math.sin(angle) - WIDTH * math.cos(angle)),  # Bottom-right
-            (-WIDTH * math.cos(angle) + WIDTH * math.sin(angle), -WIDTH * math.sin(angle) - WIDTH * math.cos(angle)),  # Bottom-left
-            (-WIDTH * math.cos(angle) - WIDTH * math.sin(angle), -WIDTH * math.sin(angle) + WIDTH * math.cos(angle))  # Top-left
-        ]
-
-        # Convert to absolute coordinates by adding the center point
-        absolute_corners = [(round(x + EASTING_OS,3), round(y + NORTHING_OS,3)) for x, y in corners]
-
-        # returns data
-        return absolute_corners
-
+# Corners of a unit foundation relative to its center: Top-right, Bottom-right, Bottom-left, Top-left
+UNIT_CORNERS = np.array([(1, 1), (1, -1), (-1, -1), (-1, 1)], dtype=float)
+
+# Foundation plan rotation (degrees) used when no per row rotation is given
+DEFAULT_ROTATION = -127
+
+
+def corner_sops(EASTING_OS, NORTHING_OS, WIDTH, LENGTH=None, rotation=DEFAULT_ROTATION):
+    """Corners of foundations centred on (EASTING_OS, NORTHING_OS) sized WIDTH x LENGTH (mm, square when LENGTH is None).
+    All arguments can be scalars or arrays (one value per foundation). Returns (easting, northing) arrays of shape (n, 4)."""
+    EASTING_OS = np.atleast_1d(np.asarray(EASTING_OS, dtype=float))
+    NORTHING_OS = np.atleast_1d(np.asarray(NORTHING_OS, dtype=float))
+    half_width = np.asarray(WIDTH, dtype=float) / 1000 / 2
+    half_length = half_width if LENGTH is None else np.asarray(LENGTH, dtype=float) / 1000 / 2
+    angle = np.radians(np.asarray(rotation, dtype=float))  # Convert degrees to radians
+    cos = np.broadcast_to(np.cos(angle), EASTING_OS.shape)[:, None]
+    sin = np.broadcast_to(np.sin(angle), EASTING_OS.shape)[:, None]
+
+    # Scale the unit corners and rotate them about the center
+    dx = np.broadcast_to(half_width, EASTING_OS.shape)[:, None] * UNIT_CORNERS[:, 0]
+    dy = np.broadcast_to(half_length, EASTING_OS.shape)[:, None] * UNIT_CORNERS[:, 1]
+    eastings = dx * cos - dy * sin
+    northings = dx * sin + dy * cos
+
+    # Convert to absolute coordinates by adding the center point
+    return (np.round(eastings + EASTING_OS[:, None], 3),
+            np.round(northings + NORTHING_OS[:, None], 3))
+
+
+def add_corners(df, rotation=DEFAULT_ROTATION, length_column=None):
+    """Returns df with the 4 corners SOPs columns, centers/width dropped and columns sorted for the deliverable.
+    rotation is a global angle in degrees or the name of a per row rotation column; length_column gives
+    rectangular foundations (WIDTH x LENGTH), square ones otherwise."""
+    # Ensure the column names match what we expect
+    required_columns = ["EASTING (mm)", "NORTHING (mm)", "WIDTH (mm)"]
+    if isinstance(rotation, str):
+        required_columns.append(rotation)
+    if length_column is not None:
+        required_columns.append(length_column)
+    if not all(col in df.columns for col in required_columns):
+        raise ValueError("Required columns not found in the Excel file.")
+
+    eastings, northings = corner_sops(
+        df["EASTING (mm)"].to_numpy(dtype=float),
+        df["NORTHING (mm)"].to_numpy(dtype=float),
+        df["WIDTH (mm)"].to_numpy(dtype=float),
+        None if length_column is None else df[length_column].to_numpy(dtype=float),
+        df[rotation].to_numpy(dtype=float) if isinstance(rotation, str) else rotation)
+
+    # New columns for corner coordinates
+    corners = {}
+    for i in range(4):
+        corners[f'{i+1} EASTING (mm)'] = eastings[:, i]
+        corners[f'{i+1} NORTHING (mm)'] = northings[:, i]
+    df = df.assign(**corners)
+
+    # move TOC col to the be the last column
+    df = df[[col for col in df.columns if col != 'FOUNDATION (T.O.C)'] + ['FOUNDATION (T.O.C)']]
+
+    # drop columns
+    drop_columns = ["EASTING (mm)", "NORTHING (mm)", "WIDTH (mm)", "DESCRPTION"]
+    if length_column is not None:
+        drop_columns.append(length_column)
+    df = df.drop(columns=drop_columns)
+
+    # move columns
+    col = df.pop("NEW_FOUNDATION REF")
+    df.insert(2, "NEW_FOUNDATION REF", col)
+    return df
+
+
+def run(boq_sops_df, output_path, rotation=DEFAULT_ROTATION, length_column=None):
+    """Step 4.3: returns the corners table and writes it to output_path (deliverable)"""
+    df = add_corners(boq_sops_df, rotation=rotation, length_column=length_column)
+
+    # Save the modified DataFrame to a new Excel file
+    write_xlsx(df, output_path)
+    logger.info(f"New file with corner data created: {output_path}")
+    return df
+
+
+def main(workspace=None):
     ####START
     # File paths
-    script_dir = Path(__file__).resolve().parent
-    folder_path = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD.xlsx"
-    output_path = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
-
-    # Get all Excel files in the directory
-    #excel_path = [f for f in os.listdir(folder_path) if f.endswith('.xlsx')]
-
-
-    try:
-        # Read the Excel file into a DataFrame
-        df = pd.read_excel(folder_path)
-
-        # Ensure the column names match what we expect
-        required_columns = ["EASTING (mm)", "NORTHING (mm)", "WIDTH (mm)"]
-        if not all(col in df.columns for col in required_columns):
-            raise ValueError("Required columns not found in the Excel file.")
-
-        # New columns for corner coordinates
-        corner_labels = ['1', '2', '3', '4']
-        for i, label in enumerate(corner_labels, 1):
-            df[f'{label} EASTING (mm)'] = None
-            df[f'{label} NORTHING (mm)'] = None
-
-        # Iterate through each row in the DataFrame
-        for index, row in df.iterrows():
-            EASTING_OS = row['EASTING (mm)']
-            NORTHING_OS = row['NORTHING (mm)']
-            WIDTH = row['WIDTH (mm)']
-
-            # Process the data with the corner_sops function
-            corners = corner_sops(EASTING_OS, NORTHING_OS, WIDTH)
-
-            # Add corner data to the corresponding new columns
-            for i, corner in enumerate(corners):
-                df.at[index, f'{i+1} EASTING (mm)'] = corner[0]
-                df.at[index, f'{i+1} NORTHING (mm)'] = corner[1]
-
-        # move TOC col to the be the last column
-        df = df[[col for col in df.columns if col != 'FOUNDATION (T.O.C)'] + ['FOUNDATION (T.O.C)']]
-
-        # drop columns
-        df = df.drop(columns=["EASTING (mm)", "NORTHING (mm)","WIDTH (mm)","DESCRPTION"])
-
-        # move columns
-        col = df.pop("NEW_FOUNDATION REF")
-        df.insert(2, "NEW_FOUNDATION REF", col)
-
-        # Save the modified DataFrame to a new Excel file
-        df.to_excel(output_path, index=False)
-        print(f"New file with corner data created: {output_path}")
+    workspace = workspace or Workspace.default()
+    folder_path = table_path(workspace.shared, "04_Aug25-BOQ_SOPs_from_CAD")
+    output_path = workspace.shared / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    # Read the intermediate table into a DataFrame
+    df = read_table(folder_path)
+    return run(df, output_path)
@@ -1,92 +1,130 @@
 #####################################################################################################################################
 # Create CAD QA DXF
 import ezdxf
-from pathlib import Path
+from workspace import Workspace
+from runlog import get_logger
+import numpy as np
 import pandas as pd
 
-def main():
-    # Path to save your DXF file
-    script_dir = Path(__file__).resolve().parent
-    file_excel = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
-    output_dxf = script_dir / "shared" / "04_CAD_QA_Final.dxf"
+logger = get_logger(__name__)
+
+# QA annotation fields: (label, column, block attribute tag)
+QA_FIELDS = [
+    ("CIRCUIT REF", "CIRCUIT REF", "CIRCUIT_REF"),
+    ("FOUNDATION REF", "FOUNDATION REF", "FOUNDATION_REF"),
+    ("NEW FOUNDATION REF", "NEW_FOUNDATION REF", "NEW_FOUNDATION_REF"),
+    ("DUCT REQUIRED", "DUCT REQUIRED", "DUCT_REQUIRED"),
+    ("RATING (Kv)", "RATING (Kv)", "RATING"),
+    ("PHASE", "PHASE", "PHASE"),
+    ("EQUIPMENT", "EQUIPMENT", "EQUIPMENT"),
+    ("FOUNDATION TYPE", "FOUNDATION TYPE", "FOUNDATION_TYPE"),
+]
+MARKER_BLOCK = "SOP_MARKER"   # 50mm circle on a single SOP
+QA_BLOCK = "SOP_QA"           # QA fields as attributes (annotation="attribs")
+MARKER_RADIUS = 0.05          # 50mm diameter
+TEXT_HEIGHT = 0.1
+LINE_SPACING = TEXT_HEIGHT * 5 / 3  # MTEXT default line spacing
+VALUE_OFFSET = 2.0                  # x offset of the attribute values after the labels
+
+
+def sop_arrays(df):
+    """(n, 4) eastings and northings of SOPs 1-4 (NaN when missing) and the (n, 4) valid mask"""
+    def column(name):
+        if name in df.columns:
+            return pd.to_numeric(df[name], errors="coerce").to_numpy(dtype=float)
+        return np.full(len(df), np.nan)
+
+    eastings = np.column_stack([column(f"{i} EASTING (mm)") for i in range(1, 5)])
+    northings = np.column_stack([column(f"{i} NORTHING (mm)") for i in range(1, 5)])
+    return eastings, northings, ~(np.isnan(eastings) | np.isnan(northings))
+
+
+def add_foundation_blocks(doc, eastings, northings):
+    """One block (4 markers + outline) per distinct foundation shape, relative to SOP 1.
+    Returns the block name of each row."""
+    offsets = np.round(np.column_stack([eastings[:, 1:] - eastings[:, :1], northings[:, 1:] - northings[:, :1]]), 6)
+    shapes, shape_of_row = np.unique(offsets, axis=0, return_inverse=True)
+    names = []
+    for k, shape in enumerate(shapes):
+        points = [(0.0, 0.0)] + list(zip(shape[:3], shape[3:]))
+        block = doc.blocks.new(name=f"SOP_FOUNDATION_{k + 1}")
+        for point in points:
+            block.add_circle(point, radius=MARKER_RADIUS)
+        block.add_lwpolyline(points + [points[0]])
+        names.append(block.name)
+    return [names[k] for k in shape_of_row.ravel()]
+
+
+def add_qa_block(doc):
+    """Labels as TEXT and the values as ATTDEFs, laid out like the QA MTEXT"""
+    block = doc.blocks.new(name=QA_BLOCK)
+    for i, (label, _, tag) in enumerate(QA_FIELDS):
+        y = -(TEXT_HEIGHT + i * LINE_SPACING)
+        block.add_text(f"{label}:", height=TEXT_HEIGHT, dxfattribs={"insert": (0, y)})
+        block.add_attdef(tag, insert=(VALUE_OFFSET, y), dxfattribs={"height": TEXT_HEIGHT, "prompt": label})
 
-    #read excel
-    df = pd.read_excel(file_excel)
 
+def run(df, output_dxf, annotation="mtext"):
+    """Step 4.4: writes the CAD QA DXF (deliverable) from the corners table.
+
+    Foundations with 4 SOPs are one INSERT of a shared foundation block, partial ones get a marker
+    block per SOP plus an outline. annotation="attribs" writes the QA fields as block attributes
+    instead of one MTEXT (queryable in CAD, but about twice the file size).
+    """
     # Create new DXF
     doc = ezdxf.new(dxfversion='R2010')
     msp = doc.modelspace()
+    layer = {"layer": "ANNOTATIONS"}
+
+    # Column arrays instead of per row lookups
+    n = len(df)
+    eastings, northings, valid = sop_arrays(df)
+    complete = valid.all(axis=1)
+    values = [df[column].astype(str).to_numpy() if column in df.columns else np.full(n, "") for _, column, _ in QA_FIELDS]
+
+    marker = doc.blocks.new(name=MARKER_BLOCK)
+    marker.add_circle((0, 0), radius=MARKER_RADIUS)
+    foundation_blocks = iter(add_foundation_blocks(doc, eastings[complete], northings[complete]))
+    if annotation == "attribs":
+        add_qa_block(doc)
 
-    # Loop through merged_df rows
-    for _, row in df.iterrows():
-        x = row["1 EASTING (mm)"]
-        y = row["1 NORTHING (mm)"]
-        z = 0
-
-        # Build multiline text string
-        text_lines = [
-            f"CIRCUIT REF: {row.get('CIRCUIT REF', '')}",
-            f"FOUNDATION REF: {row.get('FOUNDATION REF', '')}",
-            f"NEW FOUNDATION REF: {row.get('NEW_FOUNDATION REF', '')}",
-            f"DUCT REQUIRED: {row.get('DUCT REQUIRED', '')}",
-            f"RATING (Kv): {row.get('RATING (Kv)', '')}",
-            f"PHASE: {row.get('PHASE', '')}",
-            f"EQUIPMENT: {row.get('EQUIPMENT', '')}",
-            f"FOUNDATION TYPE: {row.get('FOUNDATION TYPE', '')}",
-        ]
-        full_text = "\n".join(text_lines)
-
-        # Add MTEXT with corrected attribute
-        msp.add_mtext(full_text, dxfattribs={
-            "insert": (x, y, z),
-            "char_height": 0.1,  # Correct attribute for text height
-            "layer": "ANNOTATIONS"
-        })
-        ####################################################################
-        ### ADD circles to SOPs
-        # Function to add circle if coordinates exist and are valid
-        def add_optional_circle(df_row, e_col, n_col, layer="ANNOTATIONS"):
-            easting = df_row.get(e_col)
-            northing = df_row.get(n_col)
-            if pd.notna(easting) and pd.notna(northing):
-                msp.add_circle(
-                    center=(easting, northing, 0),
-                    radius=0.05,  # 50mm diameter
-                    dxfattribs={"layer": layer}
-                )
-
-        # Add additional circles for 2/3/4 EASTING/NORTHING if available
-        add_optional_circle(row, "1 EASTING (mm)", "1 NORTHING (mm)")
-        add_optional_circle(row, "2 EASTING (mm)", "2 NORTHING (mm)")
-        add_optional_circle(row, "3 EASTING (mm)", "3 NORTHING (mm)")
-        add_optional_circle(row, "4 EASTING (mm)", "4 NORTHING (mm)")
-        ####################################################################
-        # Collect all valid (x, y) points in order: 1 → 2 → 3 → 4
-        line_points = []
-
-        # Main point (1)
-        x1 = row.get("1 EASTING (mm)")
-        y1 = row.get("1 NORTHING (mm)")
-        if pd.notna(x1) and pd.notna(y1):
-            line_points.append((x1, y1))
-
-        # Optional extra points (2 to 4)
-        for i in range(2, 5):
-            xi = row.get(f"{i} EASTING (mm)")
-            yi = row.get(f"{i} NORTHING (mm)")
-            if pd.notna(xi) and pd.notna(yi):
-                line_points.append((xi, yi))
-
-        # Draw polyline if we have at least 2 points
-        if len(line_points) >= 2:
-            # Append first point to end to close loop
-            line_points.append(line_points[0])
-            # Convert to 3D tuples (x, y, z=0)
-            line_points_3d = [(pt[0], pt[1], 0) for pt in line_points]
-
-            msp.add_lwpolyline(line_points_3d, dxfattribs={"layer": "ANNOTATIONS"})
+    for r in range(n):
+        e, nn, ok = eastings[r], northings[r], valid[r]
 
+        # SOP markers and outline 1 → 2 → 3 → 4
+        if complete[r]:
+            msp.add_blockref(next(foundation_blocks), (e[0], nn[0]), dxfattribs=layer)
+        else:
+            for x, y in zip(e[ok], nn[ok]):
+                msp.add_blockref(MARKER_BLOCK, (x, y), dxfattribs=layer)
+            if ok.sum() >= 2:
+                points = list(zip(e[ok], nn[ok]))
+                msp.add_lwpolyline(points + [points[0]], dxfattribs=layer)
+
+        # QA fields on SOP 1
+        if not ok[0]:
+            continue
+        x, y = e[0], nn[0]
+        if annotation == "attribs":
+            ref = msp.add_blockref(QA_BLOCK, (x, y), dxfattribs=layer)
+            for i, (_, _, tag) in enumerate(QA_FIELDS):
+                ref.add_attrib(tag, values[i][r], insert=(x + VALUE_OFFSET, y - TEXT_HEIGHT - i * LINE_SPACING),
+                               dxfattribs={**layer, "height": TEXT_HEIGHT})
+        else:
+            text = "\n".join(f"{label}: {values[i][r]}" for i, (label, _, _) in enumerate(QA_FIELDS))
+            msp.add_mtext(text, dxfattribs={**layer, "insert": (x, y, 0), "char_height": TEXT_HEIGHT})
 
     # Save DXF
     doc.saveas(output_dxf)
-    print(f"✅ DXF file saved to: {output_dxf}")
\ No newline at end of file
+    logger.info(f"✅ DXF file saved to: {output_dxf}")
+
+
+def main(workspace=None):
+    # Path to save your DXF file
+    workspace = workspace or Workspace.default()
+    file_excel = workspace.shared / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
+    output_dxf = workspace.shared / "04_CAD_QA_Final.dxf"
+
+    #read excel
+    df = pd.read_excel(file_excel)
+    run(df, output_dxf)
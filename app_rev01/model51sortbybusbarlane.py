@@ -1,25 +1,83 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-def main():
-    from pathlib import Path
+from workspace import Workspace
+from runlog import get_logger
+from artifacts import write_xlsx
 
-    # Paths
-    script_dir = Path(__file__).resolve().parent
-    file_excel = script_dir / "shared" / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
-    output_folder = script_dir / "shared" / "drawingdata"
+logger = get_logger(__name__)
 
-    # Load Excel file
-    df = pd.read_excel(file_excel)
-    df.columns = df.columns.str.strip()  # Clean up headers
+# Circuit workbooks per writer process, fewer circuits are written inline
+TABLES_PER_WORKER = 25
+# Excel sheet names: at most 31 characters, none of []:*?/\
+SHEET_NAME_LENGTH = 31
 
-    # Loop through each unique CIRCUIT REF
-    for circuit in df["CIRCUIT REF"].dropna().unique():
-        circuit_df = df[df["CIRCUIT REF"] == circuit]
 
+def split_circuits(df):
+    """{file stem: circuit table} in one pass over df, circuits in order of first appearance"""
+    tables = {}
+    for circuit, circuit_df in df.groupby("CIRCUIT REF", sort=False, observed=True):
         # Create a safe filename by replacing spaces or slashes
         safe_circuit_name = str(circuit).replace(" ", "_").replace("/", "-")
-        output_file = output_folder / f"{safe_circuit_name}.xlsx"
+        tables[safe_circuit_name] = circuit_df
+    return tables
+
+
+def sheet_names(names):
+    """{file stem: sheet name}, names made valid and unique (Excel ignores case)"""
+    sheets = {}
+    used = set()
+    for name in names:
+        sheet = re.sub(r"[\[\]:*?/\\]", "-", name)[:SHEET_NAME_LENGTH]
+        base, i = sheet, 1
+        while sheet.lower() in used:
+            i += 1
+            sheet = f"{base[:SHEET_NAME_LENGTH - len(str(i)) - 1]}~{i}"
+        used.add(sheet.lower())
+        sheets[name] = sheet
+    return sheets
+
+
+def write_circuits(tables, output_folder, workers=None):
+    """Writes one workbook per circuit table to output_folder, on a process pool for many circuits
+    (workers=None uses up to all CPUs, 1 writes inline). Returns the paths."""
+    jobs = [(df, output_folder / f"{name}.xlsx") for name, df in tables.items()]
+    workers = min(workers or os.cpu_count() or 1, -(-len(jobs) // TABLES_PER_WORKER))
+    if workers <= 1:
+        return [write_xlsx(*job) for job in jobs]
+
+    logger.info(f"Writing {len(jobs)} circuit workbooks on {workers} processes")
+    # spawned, not forked: the app server forking with its job and stage threads running is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(write_xlsx, *job) for job in jobs]
+        return [future.result() for future in futures]
 
-        # Write to Excel
-        circuit_df.to_excel(output_file, index=False)
 
-    print("✅ Done! Excel files written to:", output_folder)
+def run(df, output_folder, workbook=None, workers=None):
+    """Step 5.1: returns {file stem: circuit table} and writes one workbook per CIRCUIT REF,
+    or with workbook (file name) a single workbook holding one sheet per circuit"""
+    df = df.copy()
+    df.columns = df.columns.str.strip()  # Clean up headers
+    tables = split_circuits(df)
+
+    if workbook is not None:
+        sheets = sheet_names(tables)
+        output_file = write_xlsx({sheets[name]: circuit_df for name, circuit_df in tables.items()}, output_folder / workbook)
+        logger.info(f"✅ Done! {len(tables)} circuit sheets written to: {output_file}")
+    else:
+        write_circuits(tables, output_folder, workers)
+        logger.info(f"✅ Done! {len(tables)} Excel files written to: {output_folder}")
+    return tables
+
+
+def main(workspace=None):
+    # Paths
+    workspace = workspace or Workspace.default()
+    file_excel = workspace.shared / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
+    output_folder = workspace.drawingdata
+
+    # Load Excel file
+    df = pd.read_excel(file_excel)
+    return run(df, output_folder)
@@ -1,66 +1,189 @@
+import functools
+import hashlib
+import multiprocessing
+import os
+import shutil
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from workspace import Workspace
+from runlog import get_logger
+from stagecache import touch
 import pandas as pd
-import matplotlib.pyplot as plt
+from PIL import Image
 
-def main():
-    # Define file paths
-    from pathlib import Path
-    script_dir = Path(__file__).resolve().parent
-    input_path = script_dir / "shared" / "drawingdata"
-    
-    # Get all Excel files in the directory
-    excel_path = list(input_path.glob("*.xlsx"))
+logger = get_logger(__name__)
+
+# Bump when the table layout changes so existing PNGs are re-rendered
+RENDER_VERSION = "1"
+# PNG text chunk holding the hash of the rendered table
+HASH_KEY = "TableHash"
+
+
+# Table font, the first one installed
+FONTS = ["Arial", "DejaVu Sans"]
+FONT_SIZE = 10
+
+
+def figure_classes():
+    """(Figure, FigureCanvasAgg), imported on first use: reruns often have no table to render.
+    No pyplot: its figure manager and rcParams are shared by the app's threads."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    return Figure, FigureCanvasAgg
 
-    for file in excel_path:
-        print(f"Processing {file.name} please wait!")
 
-        # Load Excel file
-        df = pd.read_excel(file)
+@functools.lru_cache(maxsize=None)
+def table_font():
+    from matplotlib import font_manager
+    installed = {font.name for font in font_manager.fontManager.ttflist}
+    return next((name for name in FONTS if name in installed), "sans-serif")
 
-        # Create figure and axis
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.axis('tight')
-        ax.axis('off')
 
-        # Create table
-        table = ax.table(cellText=df.values, colLabels=df.columns, cellLoc='center', loc='center')
+def table_hash(df):
+    content = RENDER_VERSION + "\n" + df.to_csv(index=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
-        # Format table
-        for (i, j), cell in table.get_celld().items():
-            cell.set_fontsize(10)
-            cell.set_facecolor('white')
-            if i == 0:
-                cell.set_text_props(weight='bold', fontname='Arial')
-                cell.set_facecolor('#D3D3D3')
-            else:
-                cell.set_text_props(fontname='Arial')
 
-        table.auto_set_column_width(col=list(range(len(df.columns))))
+def png_hash(output_path):
+    """Table hash stored in an existing PNG, None when missing or unreadable"""
+    try:
+        with Image.open(output_path) as image:
+            return image.text.get(HASH_KEY)
+    except (OSError, AttributeError):
+        return None
 
-        # Generate image filename
-        image_filename = file.stem + ".png"
-        output_path = script_dir / "shared" / "drawingdata" / image_filename
 
-        # Save image
-        plt.savefig(output_path, bbox_inches="tight", dpi=300)
-        plt.close()
+def render_table(df, output_path, content_hash=None):
+    Figure, FigureCanvasAgg = figure_classes()
+    # Create figure and axis
+    fig = Figure(figsize=(10, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.axis('tight')
+    ax.axis('off')
 
-        print(f"✅ Table image saved at: {output_path}")
+    # Create table
+    table = ax.table(cellText=df.values, colLabels=df.columns, cellLoc='center', loc='center')
 
+    # Format table
+    table.set_fontsize(FONT_SIZE)
+    for (i, j), cell in table.get_celld().items():
+        cell.set_text_props(fontfamily=table_font())
+        cell.set_facecolor('white')
+        if i == 0:
+            cell.set_text_props(weight='bold')
+            cell.set_facecolor('#D3D3D3')
 
-    import zipfile
-    # Create the zip in the current script directory
-    zip_path = script_dir / "drawingdata.zip"
+    table.auto_set_column_width(col=list(range(len(df.columns))))
+
+    # Save image
+    metadata = {HASH_KEY: content_hash} if content_hash else None
+    fig.savefig(output_path, bbox_inches="tight", dpi=300, metadata=metadata)
+    return output_path
+
+
+def zip_folder(input_path, downloads_folder):
+    # Create the zip next to the drawing data folder
+    zip_path = input_path.parent / "drawingdata.zip"
     with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
         for file_path in input_path.rglob("*"):
             if file_path.is_file():
                 zf.write(file_path, arcname=file_path.relative_to(input_path))
 
     # Create downloads folder if it doesn't exist
-    downloads_folder = script_dir / "downloads"
     downloads_folder.mkdir(exist_ok=True)
 
     # Move the zip to the downloads folder
     final_zip_path = downloads_folder / zip_path.name
     zip_path.replace(final_zip_path)
 
-    print(f"ZIP created and moved to {final_zip_path}")
+    logger.info(f"ZIP created and moved to {final_zip_path}")
+    return final_zip_path
+
+
+def cached_image(image_cache, content_hash):
+    """PNG of a table with this hash rendered by an earlier run, None when not in the image cache"""
+    if image_cache is None:
+        return None
+    cached = Path(image_cache) / f"{content_hash}.png"
+    if not cached.exists():
+        return None
+    touch(cached)
+    return cached
+
+
+def store_image(image_cache, output_path, content_hash):
+    # written under a temporary name first, so other runs never copy a half written PNG
+    image_cache = Path(image_cache)
+    image_cache.mkdir(parents=True, exist_ok=True)
+    tmp = image_cache / f"{content_hash}.{uuid.uuid4().hex}.tmp"
+    shutil.copy2(output_path, tmp)
+    os.replace(tmp, image_cache / f"{content_hash}.png")
+
+
+def render_tables(tables, input_path, workers=None, image_cache=None):
+    """Renders {file stem: table} to PNGs in input_path. Tables whose PNG already holds the same content hash
+    are skipped, and with image_cache (folder of <table hash>.png) tables rendered by an earlier run are
+    copied from it. Rendering runs on a process pool (workers=None uses all CPUs, 1 renders inline)."""
+    jobs = []
+    copied = 0
+    for name, df in tables.items():
+        output_path = input_path / f"{name}.png"
+        content_hash = table_hash(df)
+        if png_hash(output_path) == content_hash:
+            logger.debug("Skipping %s, table unchanged", name)
+            continue
+        cached = cached_image(image_cache, content_hash)
+        if cached is not None:
+            shutil.copy2(cached, output_path)
+            copied += 1
+            logger.debug("Copied %s from the image cache, table unchanged", name)
+            continue
+        jobs.append((df, output_path, content_hash))
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        rendered = [render_table(*job) for job in jobs]
+    else:
+        logger.info(f"Rendering {len(jobs)} tables on {workers} processes please wait!")
+        # spawned, not forked: the app server forking with its job and stage threads running is unsafe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(render_table, *job) for job in jobs]
+            rendered = [future.result() for future in futures]
+
+    for _, output_path, content_hash in jobs:
+        logger.debug("Table image saved at: %s", output_path)
+        if image_cache is not None:
+            store_image(image_cache, output_path, content_hash)
+    logger.info(f"✅ {len(rendered)} table images saved in {input_path} ({len(tables) - len(jobs)} unchanged)")
+    return rendered
+
+
+def drop_stale_images(tables, input_path):
+    """Deletes the PNGs in input_path without a table in tables (e.g. copied from the baseline run
+    for a circuit the revision removed), so they don't end up in the zip"""
+    stale = [png for png in input_path.glob("*.png") if png.stem not in tables]
+    for png in stale:
+        png.unlink()
+    if stale:
+        logger.info(f"Removed {len(stale)} table images of circuits no longer in the drawings")
+    return stale
+
+
+def run(tables, input_path, downloads_folder, workers=None, image_cache=None):
+    """Step 5.2: renders {file stem: table} to PNGs in input_path and zips the folder into downloads_folder"""
+    drop_stale_images(tables, input_path)
+    render_tables(tables, input_path, workers, image_cache)
+    return zip_folder(input_path, downloads_folder)
+
+
+def main(workspace=None):
+    # Define file paths
+    workspace = workspace or Workspace.default()
+    input_path = workspace.drawingdata
+
+    # Get all Excel files in the directory
+    tables = {file.stem: pd.read_excel(file) for file in input_path.glob("*.xlsx")}
+    return run(tables, input_path, workspace.downloads)
@@ -0,0 +1,470 @@
+import contextvars
+import importlib
+import importlib.util
+import json
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+import pandas as pd
+
+from stagecache import Checkpoints, StageCache, file_hash, stage_key
+from stagestats import StageStats, StageTimer, count_bytes, count_rows, save_stats
+import incremental
+import ingest
+import runlog
+from workspace import SCRIPT_DIR, Workspace
+
+### THIS SCRIPT ##################################################
+### Chains model1getsops ... model52tabletoimage in memory.      #
+### Stages hand DataFrames to each other. The lean profile only #
+### writes the deliverables, the debug one also the per stage   #
+### DXF/table diagnostics in shared/. Stage outputs are cached  #
+### under a hash of their inputs and parameters so a rerun only  #
+### recomputes the stages whose inputs changed. Every run reads  #
+### and writes its own Workspace (uploads/ shared/ downloads/).  #
+### Model modules (ezdxf, shapely, matplotlib...) are imported   #
+### when their stage runs, or ahead of time by prewarm().        #
+### Stages run as a dependency graph: a stage starts as soon as  #
+### the stages producing its inputs are done, so independent     #
+### ones (e.g. lane and text names) run at the same time.        #
+### A stage error stops the run; completed stages are kept as   #
+### checkpoints so the run can be resumed from the failed stage. #
+### Progress goes through the runlog loggers to the log function #
+### of the run (app log panel, batch run.log).                   #
+##################################################################
+
+logger = runlog.get_logger(__name__)
+
+# Uploads required by the pipeline (app.py uploader keys)
+INPUT_KEYS = ["ga_dxf", "busbar_dxf", "found_id_dxf", "found_type_sheet", "boq_sheet"]
+
+# Files the stages write straight to downloads/ (plus the drawingdata zip)
+DELIVERABLES = ["04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx", "04_CAD_QA_Final.dxf"]
+
+# Output profiles: lean writes the deliverables only, debug also the per stage diagnostics
+OUTPUT_PROFILES = ("lean", "debug")
+DEFAULT_PROFILE = "lean"
+
+# Stage cache shared by all workspaces (entries are content addressed)
+CACHE_DIR = SCRIPT_DIR / "shared" / ".cache"
+# Bump to invalidate every cached stage output
+CACHE_VERSION = "2"
+# Modules besides the model module whose source is part of every stage key: the stage
+# functions below and the helpers the models read and write through
+KEY_MODULES = ["pipeline", "artifacts", "ingest", "dxfcache"]
+# Parsed DXF entities (dxfcache), inside the stage cache folder
+ENTITY_CACHE = "dxf"
+# folder of CACHE_DIR holding the circuit table PNGs by table hash (model52)
+IMAGE_CACHE = "png"
+# Per stage stats of a run, saved next to the deliverables
+STATS_FILE = "run_stats.json"
+# Stages running at the same time (threads), 1 runs them one by one in STAGES order
+MAX_PARALLEL_STAGES = 4
+
+
+@dataclass
+class Context:
+    workspace: Workspace
+    debug_dir: Path = None  # diagnostics folder (debug profile), None in the lean profile
+    previous: dict = None  # site state of the baseline run (incremental runs)
+    entity_cache: Path = None  # dxfcache folder, None parses the DXFs every time
+    image_cache: Path = None  # table PNGs of earlier runs, None renders every changed table
+
+    def previous_state(self, name):
+        return self.previous.get(name) if self.previous else None
+
+    def diagnostic(self, name):
+        """Path of a diagnostic file in debug_dir, None when diagnostics are not written"""
+        return self.debug_dir / name if self.debug_dir is not None else None
+
+
+@dataclass
+class Stage:
+    name: str
+    label: str
+    func: Callable       # func(ctx, **inputs, **params) -> ({output: value}, [files written])
+    module: str          # model module name, its source is part of the cache key
+    inputs: tuple        # upload keys (INPUT_KEYS) or outputs of earlier stages
+    outputs: tuple
+    params: dict = field(default_factory=dict)
+    counts: Callable = None  # counts(**inputs, **outputs) -> {name: count} for the run stats
+
+
+@dataclass
+class StageResult:
+    stage: str
+    status: str = "skipped"  # completed | cached | resumed | failed | skipped (not run after a failure)
+    files: list = field(default_factory=list)  # files written (or restored) by the stage
+    stats: StageStats = None
+    error: str = None
+
+
+@dataclass
+class PipelineResult:
+    sops: pd.DataFrame = None          # step 1: one row per 3DFACE vertex
+    foundations: pd.DataFrame = None   # step 1: one row per foundation center
+    lane_names: pd.DataFrame = None    # step 2: names from busbar lanes
+    text_names: pd.DataFrame = None    # step 3: names from drawing ID text
+    new_vs_old: pd.DataFrame = None    # step 4.1: lane names matched with text names
+    boq_sops: pd.DataFrame = None      # step 4.2: BoQ rows with CAD SOPs and foundation types
+    corners: pd.DataFrame = None       # step 4.3: BoQ rows with 4 corners SOPs
+    circuit_tables: dict = field(default_factory=dict)  # step 5.1: {file stem: circuit table}
+    downloads: list = field(default_factory=list)       # files copied to downloads/
+    cached_stages: list = field(default_factory=list)   # stages restored from the cache
+    stats: list = field(default_factory=list)           # StageStats per stage
+    stages: list = field(default_factory=list)          # StageResult per stage
+    changes: dict = None                                # change report against the baseline run
+
+
+class StageError(RuntimeError):
+    """A stage failed. result is the PipelineResult of the stages run so far."""
+
+    def __init__(self, stage, error, result):
+        super().__init__(f"Stage {stage} failed: {error}")
+        self.stage = stage
+        self.result = result
+
+
+#####################################################################
+# Stages
+def _written(*paths):
+    # diagnostics the stage wrote, the lean profile gives None paths
+    return [path for path in paths if path is not None]
+
+
+def _sops(ctx, ga_dxf, **params):
+    import model1getsops
+    output_dxf = ctx.diagnostic("01_Aug25-2D_SOPs_From_CAD.dxf")
+    sops, foundations = model1getsops.run(ga_dxf, output_dxf, debug_dir=ctx.debug_dir, entity_cache=ctx.entity_cache, **params)
+    return {"sops": sops, "foundations": foundations}, _written(output_dxf)
+
+
+def _lane_names(ctx, busbar_dxf, foundations, **params):
+    import model2namesfromlanes
+    output_dxf = ctx.diagnostic("02_Aug25-Names_From_2D_SOPs.dxf")
+    lane_state = {}
+    lane_names = model2namesfromlanes.run(busbar_dxf, foundations, output_dxf, debug_dir=ctx.debug_dir,
+                                          previous=ctx.previous_state("lane_state"), state=lane_state,
+                                          entity_cache=ctx.entity_cache, **params)
+    return {"lane_names": lane_names, "lane_state": lane_state}, _written(output_dxf)
+
+
+def _text_names(ctx, found_id_dxf, sops, **params):
+    import model3associatenames
+    output_dxf = ctx.diagnostic("03_Aug25-Associated_Foundation_Name.dxf")
+    text_state = {}
+    text_names = model3associatenames.run(found_id_dxf, sops, output_dxf, debug_dir=ctx.debug_dir,
+                                          previous=ctx.previous_state("text_state"), state=text_state,
+                                          entity_cache=ctx.entity_cache, **params)
+    return {"text_names": text_names, "text_state": text_state}, _written(output_dxf)
+
+
+def _new_vs_old(ctx, lane_names, text_names, **params):
+    import model41combineboqcad
+    new_vs_old = model41combineboqcad.run(lane_names, text_names, debug_dir=ctx.debug_dir, **params)
+    return {"new_vs_old": new_vs_old}, []
+
+
+def _boq_sops(ctx, boq_sheet, found_type_sheet, new_vs_old, **params):
+    import model42combineboqcad
+    output_dxf = ctx.diagnostic("04_CAD_QA_Step2.dxf")
+    boq_sops = model42combineboqcad.run(boq_sheet, found_type_sheet, new_vs_old, output_dxf, debug_dir=ctx.debug_dir, **params)
+    return {"boq_sops": boq_sops}, _written(output_dxf)
+
+
+def _corners(ctx, boq_sops, **params):
+    import model43combineboqcad
+    output_path = ctx.workspace.downloads / "04_Aug25-BOQ_SOPs_from_CAD_corners.xlsx"
+    corners = model43combineboqcad.run(boq_sops, output_path, **params)
+    return {"corners": corners}, [output_path]
+
+
+def _cad_qa(ctx, corners, **params):
+    import model44cadqa
+    output_dxf = ctx.workspace.downloads / "04_CAD_QA_Final.dxf"
+    model44cadqa.run(corners, output_dxf, **params)
+    return {}, [output_dxf]
+
+
+def _circuit_tables(ctx, corners, **params):
+    import model51sortbybusbarlane
+    circuit_tables = model51sortbybusbarlane.run(corners, ctx.workspace.drawingdata, **params)
+    if params.get("workbook") is not None:
+        return {"circuit_tables": circuit_tables}, [ctx.workspace.drawingdata / params["workbook"]]
+    return {"circuit_tables": circuit_tables}, [ctx.workspace.drawingdata / f"{name}.xlsx" for name in circuit_tables]
+
+
+def _drawing_tables(ctx, circuit_tables, **params):
+    import model52tabletoimage
+    drawingdata_zip = model52tabletoimage.run(circuit_tables, ctx.workspace.drawingdata, ctx.workspace.downloads,
+                                                 image_cache=ctx.image_cache, **params)
+    pngs = [ctx.workspace.drawingdata / f"{name}.png" for name in circuit_tables]
+    return {"drawingdata_zip": drawingdata_zip}, pngs + [drawingdata_zip]
+
+
+#####################################################################
+# Run stats counts
+def _sops_counts(sops, foundations, **_):
+    return {"faces_scanned": sops.attrs.get("faces_scanned"), "faces_kept": int(sops["element"].nunique()),
+            "foundations": len(foundations)}
+
+
+def _lane_names_counts(foundations, lane_names, lane_state, **_):
+    per_lane = lane_names["FOUNDATION REF"].str.replace(r"P\d+$", "", regex=True).value_counts()
+    return {"foundations": len(foundations), "points_assigned": len(lane_names),
+            "unassigned": len(foundations) - len(lane_names), "lanes": len(per_lane),
+            "points_recomputed": lane_state.get("recomputed"),
+            "points_per_lane": {lane: int(n) for lane, n in per_lane.sort_index().items()}}
+
+
+def _text_names_counts(text_names, text_state, **_):
+    return {"texts_matched": len(text_names), "texts_recomputed": text_state.get("recomputed")}
+
+
+def _new_vs_old_counts(new_vs_old, **_):
+    status = new_vs_old["Match Status"].value_counts()
+    return {"matched": int(status.get("MATCHED", 0)), "no_match": int(status.get("NO MATCH", 0))}
+
+
+def _circuit_tables_counts(circuit_tables, **_):
+    return {"circuits": len(circuit_tables)}
+
+
+STAGES = [
+    Stage("sops", "Step 1/5: Calculating foundations SOPs from geometry file...",
+          _sops, "model1getsops", ("ga_dxf",), ("sops", "foundations"),
+          {"streaming": True, "perimeter_band": (5.9, 6.1), "level": 81500}, _sops_counts),
+    Stage("lane_names", "Step 2/5: Generate foundations names from CAD busbar lanes...",
+          _lane_names, "model2namesfromlanes", ("busbar_dxf", "foundations"), ("lane_names", "lane_state"),
+          {"radius": 2, "assignment": "first"}, _lane_names_counts),
+    Stage("text_names", "Step 3/5: Associate foundations CAD id text with SOPs info...",
+          _text_names, "model3associatenames", ("found_id_dxf", "sops"), ("text_names", "text_state"),
+          {"text_types": ("MTEXT",), "prefix": "F", "level": 81500}, _text_names_counts),
+    Stage("new_vs_old", "Step 4/5: Checking data consistency between CAD files...",
+          _new_vs_old, "model41combineboqcad", ("lane_names", "text_names"), ("new_vs_old",),
+          {"tolerance": 0}, _new_vs_old_counts),
+    Stage("boq_sops", "Step 4/5: Matching CAD busbar lanes SOPs with excel BoQ info and assigning foundation types...",
+          _boq_sops, "model42combineboqcad", ("boq_sheet", "found_type_sheet", "new_vs_old"), ("boq_sops",)),
+    Stage("corners", "Step 4/5: Generating foundations 4 corners SOPs info...",
+          _corners, "model43combineboqcad", ("boq_sops",), ("corners",),
+          {"rotation": -127, "length_column": None}),
+    Stage("cad_qa", "Step 4/5: Generating CAD-QA control files...",
+          _cad_qa, "model44cadqa", ("corners",), (),
+          {"annotation": "mtext"}),
+    Stage("circuit_tables", "Step 5/5: Generating busbar lanes tables...",
+          _circuit_tables, "model51sortbybusbarlane", ("corners",), ("circuit_tables",),
+          {"workbook": None}, _circuit_tables_counts),
+    Stage("drawing_tables", "Step 5/5: Generating drawing tables png files...",
+          _drawing_tables, "model52tabletoimage", ("circuit_tables",), ("drawingdata_zip",)),
+]
+
+
+def module_file(name):
+    """Source file of a stage module, found without importing it"""
+    return importlib.util.find_spec(name).origin
+
+
+def prewarm(log=None):
+    """Imports the stage modules and their heavy dependencies so the first run doesn't wait for them.
+    Returns {module: import seconds}."""
+    timings = {}
+    for stage in STAGES:
+        start = time.perf_counter()
+        module = importlib.import_module(stage.module)
+        if hasattr(module, "figure_classes"):
+            module.figure_classes()
+        timings[stage.module] = round(time.perf_counter() - start, 3)
+    if log is not None:
+        log(f"Pipeline modules loaded in {sum(timings.values()):.1f}s")
+    return timings
+
+
+def stage_graph(stages):
+    """{stage name: names of the stages producing its inputs}, raises ValueError for inputs nothing produces"""
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    graph = {}
+    for stage in stages:
+        unknown = [name for name in stage.inputs if name not in producers and name not in INPUT_KEYS]
+        if unknown:
+            raise ValueError(f"Stage {stage.name} needs {', '.join(unknown)}, which no stage produces")
+        graph[stage.name] = {producers[name] for name in stage.inputs if name in producers}
+    return graph
+
+
+def run_stage(stage, key, inputs, stage_params, ctx, cache, use_cache, checkpoints, resume, run_start):
+    """Runs one stage, or restores it from its checkpoint (resume) or the cache. Returns (outputs, StageResult).
+    Errors are raised, a stage without one of its outputs is an error."""
+    stats = StageStats(stage.name, started_s=round(time.perf_counter() - run_start, 4))
+    result = StageResult(stage.name, "completed", stats=stats)
+    # debug runs always recompute so the diagnostics get written, and don't fill the cache with them
+    use_cache = use_cache and ctx.debug_dir is None
+    with StageTimer(stats):
+        resumed = checkpoints.load(stage.name, key) if resume else None
+        cached = cache.load(stage.name, key, ctx.workspace.root) if resumed is None and use_cache else None
+        if resumed is not None:
+            logger.info(f"{stage.label} (resumed)")
+            outputs, files = resumed
+            stats.resumed = True
+            result.status = "resumed"
+        elif cached is not None:
+            logger.info(f"{stage.label} (cached)")
+            outputs, files = cached
+            stats.cached = True
+            result.status = "cached"
+        else:
+            logger.info(stage.label)
+            outputs, files = stage.func(ctx, **inputs, **stage_params)
+            missing = [name for name in stage.outputs if outputs.get(name) is None]
+            if missing:
+                raise ValueError(f"{stage.name} produced no {', '.join(missing)}")
+            if use_cache:
+                cache.store(stage.name, key, outputs, files, ctx.workspace.root)
+        if resumed is None:
+            checkpoints.save(stage.name, key, outputs, files)
+
+    result.files = list(files)
+    stats.rows_in = count_rows(inputs.values())
+    stats.rows_out = count_rows(outputs.values())
+    stats.bytes_read = count_bytes(inputs[name] for name in stage.inputs if name in INPUT_KEYS)
+    stats.bytes_written = count_bytes(files)
+    if stage.counts is not None:
+        stats.counts = stage.counts(**inputs, **outputs)
+    return outputs, result
+
+
+def run_pipeline(input_paths, workspace=None, profile=DEFAULT_PROFILE, log=print, use_cache=True, params=None, cache_dir=None,
+                 baseline=None, max_parallel=MAX_PARALLEL_STAGES, resume=False):
+    """Runs all stages on input_paths (keys as INPUT_KEYS) and returns a PipelineResult.
+
+    profile is one of OUTPUT_PROFILES: "lean" writes the deliverables to workspace.downloads only,
+    "debug" also writes the per stage DXF/table diagnostics to workspace.shared.
+    params overrides stage parameters, e.g. {"lane_names": {"radius": 3}}. Stages whose code,
+    parameters and inputs are unchanged since an earlier run are restored from cache_dir
+    (debug runs always recompute so the diagnostics get written).
+    The DXF entities the stages read are parsed once per file content into cache_dir/dxf (dxfcache).
+    Inputs are copied into workspace.uploads, workspace defaults to the folders next to the scripts.
+    baseline is the Workspace of an earlier run of the same site: lane and text assignment is only
+    recomputed around changed foundations/lanes, and a change report is saved with the deliverables.
+    Up to max_parallel stages whose inputs are ready run at the same time. The first stage error stops
+    the run: no other stage is started and a StageError is raised once the running ones finish.
+    Completed stages are checkpointed in the workspace; resume=True reruns a failed run in the same
+    workspace from the failed stage (stages whose inputs and parameters are unchanged are restored).
+    log(msg) receives the stage labels and the records of the model loggers at the runlog level.
+    """
+    with runlog.capture(log):
+        return _run_pipeline(input_paths, workspace, profile, use_cache, params, cache_dir, baseline, max_parallel, resume)
+
+
+def _run_pipeline(input_paths, workspace, profile, use_cache, params, cache_dir, baseline, max_parallel, resume):
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile {profile!r}, expected one of {', '.join(OUTPUT_PROFILES)}")
+    graph = stage_graph(STAGES)
+    workspace = (workspace or Workspace.default()).create_folders()
+    input_paths = workspace.add_uploads({key: input_paths[key] for key in INPUT_KEYS})
+    # spreadsheet headers are checked before the DXF stages run
+    ingest.sheet_columns(input_paths["boq_sheet"], ingest.BOQ_SCHEMA)
+    ingest.sheet_columns(input_paths["found_type_sheet"], ingest.FOUNDATION_TYPES_SCHEMA)
+    previous = incremental.load_state(baseline.shared / incremental.STATE_FILE) if baseline is not None else None
+    if baseline is not None and previous is None:
+        logger.warning(f"No site state in {baseline.root}, running in full")
+    cache_dir = Path(cache_dir or CACHE_DIR)
+    ctx = Context(workspace, workspace.shared if profile == "debug" else None, previous,
+                  cache_dir / ENTITY_CACHE if use_cache else None, cache_dir / IMAGE_CACHE if use_cache else None)
+    if previous is not None:
+        # unchanged circuit tables keep their PNG (model52 skips tables with the same hash
+        # and deletes the ones of circuits the revision removed)
+        for png in baseline.drawingdata.glob("*.png"):
+            if not (workspace.drawingdata / png.name).exists():
+                shutil.copy2(png, workspace.drawingdata / png.name)
+    cache = StageCache(cache_dir)
+    checkpoints = Checkpoints(workspace.checkpoints, workspace.root)
+    if not resume:
+        checkpoints.clear()
+    params = params or {}
+
+    # value and content hash of every upload and stage output
+    values = {}
+    hashes = {}
+    for key in INPUT_KEYS:
+        values[key] = input_paths[key]
+        hashes[key] = file_hash(input_paths[key])
+
+    result = PipelineResult()
+    stage_results = {stage.name: StageResult(stage.name) for stage in STAGES}
+    pending = list(STAGES)
+    running = {}  # future: (stage, key)
+    done = set()
+    failed = None  # (stage, error) of the first failure
+    run_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel), thread_name_prefix="stage") as executor:
+        while (pending and failed is None) or running:
+            # start every stage whose inputs are ready, in STAGES order
+            for stage in [s for s in pending if graph[s.name] <= done and failed is None]:
+                pending.remove(stage)
+                stage_params = {**stage.params, **params.get(stage.name, {})}
+                key = stage_key(stage.name, [module_file(name) for name in (stage.module, *KEY_MODULES)], stage_params,
+                                {name: hashes[name] for name in stage.inputs}, version=CACHE_VERSION)
+                inputs = {name: values[name] for name in stage.inputs}
+                # the stage thread logs to this run's log function
+                future = executor.submit(contextvars.copy_context().run, run_stage, stage, key, inputs, stage_params,
+                                         ctx, cache, use_cache, checkpoints, resume, run_start)
+                running[future] = (stage, key)
+            if not running:
+                raise ValueError(f"Stages {', '.join(s.name for s in pending)} depend on each other")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    outputs, stage_result = future.result()
+                except Exception as e:
+                    stage_results[stage.name] = StageResult(stage.name, "failed", error=f"{type(e).__name__}: {e}")
+                    logger.error(f"{stage.label} failed: {e}")
+                    if failed is None:
+                        # fail fast: queued stages are dropped, running ones finish (and are checkpointed)
+                        failed = (stage, e)
+                        for other in running:
+                            other.cancel()
+                    continue
+                stage_results[stage.name] = stage_result
+                for name in stage.outputs:
+                    values[name] = outputs[name]
+                    hashes[name] = f"{key}:{name}"
+                done.add(stage.name)
+
+    # results in STAGES order
+    result.stages = [stage_results[stage.name] for stage in STAGES]
+    result.stats = [r.stats for r in result.stages if r.stats is not None]
+    result.cached_stages = [r.stage for r in result.stages if r.status == "cached"]
+    run_wall = round(time.perf_counter() - run_start, 4)
+
+    for name in ("sops", "foundations", "lane_names", "text_names", "new_vs_old", "boq_sops", "corners"):
+        setattr(result, name, values.get(name))
+    result.circuit_tables = values.get("circuit_tables", {})
+    if failed is not None:
+        stage, error = failed
+        logger.error(f"Run stopped at {stage.name}, {len(done)} of {len(STAGES)} stages completed (resume the run after fixing the inputs)")
+        raise StageError(stage.name, error, result) from error
+    result.downloads.append(values["drawingdata_zip"])
+
+    result.downloads.extend(workspace.downloads / name for name in DELIVERABLES)
+    result.downloads.append(save_stats(result.stats, workspace.downloads / STATS_FILE,
+                                       workspace=str(workspace.root), profile=profile, wall_s=run_wall,
+                                       max_parallel=max_parallel))
+
+    # site state for later incremental runs, and the changes since the baseline
+    incremental.save_state(workspace.shared / incremental.STATE_FILE, values)
+    if previous is not None:
+        result.changes = incremental.change_report(previous, values, baseline.root)
+        report_path = workspace.downloads / incremental.REPORT_FILE
+        report_path.write_text(json.dumps(result.changes, indent=2, default=str))
+        result.downloads.append(report_path)
+        logger.info(incremental.summary(result.changes))
+
+    logger.info("Process completed!")
+    return result
@@ -0,0 +1,74 @@
+import contextlib
+import contextvars
+import logging
+
+### THIS SCRIPT ##################################################
+### Leveled logging of the pipeline. Every model module has its #
+### own logger (hvsops.<module>); records go to the log function #
+### of the run that emitted them (app log panel, batch run.log)  #
+### and to stdout outside a run. Per item details are DEBUG      #
+### records, skipped at the default INFO level.                  #
+##################################################################
+
+# Parent of the module loggers
+ROOT_LOGGER = "hvsops"
+DEFAULT_LEVEL = "INFO"
+
+# log function of the current run, set by capture(). Stage threads run in a copy of the run's context.
+_run_log = contextvars.ContextVar("run_log", default=None)
+
+
+class RunLogHandler(logging.Handler):
+    """Sends formatted records to the log function of the current run, print without one"""
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            (_run_log.get() or print)(msg)
+        except Exception:
+            self.handleError(record)
+
+
+class RunLogFormatter(logging.Formatter):
+    # info lines as they are, debug ones indented, warnings and errors with their level
+    def format(self, record):
+        msg = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            return f"{record.levelname}: {msg}"
+        if record.levelno < logging.INFO:
+            return f"  {msg}"
+        return msg
+
+
+def get_logger(name):
+    """Logger of a module, get_logger(__name__) in model1getsops -> hvsops.model1getsops"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def set_level(level):
+    """Level of all the pipeline loggers ("DEBUG", "INFO", "WARNING"...)"""
+    logging.getLogger(ROOT_LOGGER).setLevel(level)
+
+
+@contextlib.contextmanager
+def capture(log):
+    """Routes the records emitted in this context (and copies of it) to log(msg)"""
+    token = _run_log.set(log)
+    try:
+        yield
+    finally:
+        _run_log.reset(token)
+
+
+def _setup():
+    root = logging.getLogger(ROOT_LOGGER)
+    if not root.handlers:
+        handler = RunLogHandler()
+        handler.setFormatter(RunLogFormatter())
+        root.addHandler(handler)
+        root.setLevel(DEFAULT_LEVEL)
+        # not repeated by handlers of the root logger (e.g. streamlit's)
+        root.propagate = False
+
+
+_setup()
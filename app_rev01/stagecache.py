@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+### THIS SCRIPT ##################################################
+### Content addressed cache of pipeline stage outputs.          #
+### A stage key hashes its code, parameters and inputs; upload  #
+### files are hashed by content, upstream outputs by the key of #
+### the stage that produced them.                               #
+### Checkpoints keep the outputs of the current run of a        #
+### workspace so a failed run can be resumed where it stopped.  #
+##################################################################
+
+# {(path, size, mtime_ns): sha256} so reruns don't re-read unchanged uploads
+_file_hashes = {}
+
+# Cache retention: entries not used for MAX_AGE_DAYS are deleted, then the least recently used
+# ones until the cache fits in MAX_CACHE_BYTES
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+MAX_AGE_DAYS = 30
+
+
+def file_hash(path):
+    path = Path(path)
+    stat = path.stat()
+    memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def stage_key(name, code_paths, params, input_hashes, version=None):
+    """Hash of everything a stage result depends on. code_paths are the source files of the stage
+    (its model module and the helper modules it uses), version is bumped to invalidate all keys."""
+    payload = {
+        "stage": name,
+        "version": version,
+        "code": [file_hash(path) for path in code_paths],
+        "params": params,
+        "inputs": input_hashes,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """Stores stage outputs (pickled) and the files the stage wrote, under root/<stage>/<key>/"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def entry(self, name, key):
+        return self.root / name / key
+
+    def load(self, name, key, base_dir):
+        """Returns (outputs, restored files) and restores the stage files under base_dir, None on a cache miss"""
+        entry = self.entry(name, key)
+        outputs_file = entry / "outputs.pkl"
+        if not outputs_file.exists():
+            return None
+        touch(entry)
+        with open(outputs_file, "rb") as f:
+            outputs = pickle.load(f)
+
+        files = []
+        files_dir = entry / "files"
+        if files_dir.exists():
+            for cached_file in files_dir.rglob("*"):
+                if cached_file.is_file():
+                    target = Path(base_dir) / cached_file.relative_to(files_dir)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(cached_file, target)
+                    files.append(target)
+        return outputs, files
+
+    def store(self, name, key, outputs, files, base_dir):
+        """Saves outputs and copies of files (paths under base_dir) for key"""
+        entry = self.entry(name, key)
+        if entry.exists():
+            return
+        # unique tmp folder, runs in other workspaces may store the same key concurrently
+        tmp = entry.with_name(f"{entry.name}.{uuid.uuid4().hex[:8]}.tmp")
+        tmp.mkdir(parents=True)
+
+        with open(tmp / "outputs.pkl", "wb") as f:
+            pickle.dump(outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for file in files:
+            file = Path(file)
+            target = tmp / "files" / file.relative_to(base_dir)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(file, target)
+
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # another run stored it first, same key means same content
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def touch(entry):
+    # last use time of a cache entry, for cleanup_cache
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+
+def folder_size(folder):
+    return sum(f.stat().st_size for f in Path(folder).rglob("*") if f.is_file())
+
+
+def cleanup_cache(root, max_bytes=MAX_CACHE_BYTES, max_age_days=MAX_AGE_DAYS, min_age_hours=1):
+    """Deletes the entries (root/<stage or dxf>/<key>/, root/png/<hash>.png) not used for max_age_days,
+    then the least recently used ones until root holds at most max_bytes. Entries used within min_age_hours
+    are kept (running jobs). Returns the deleted entries."""
+    root = Path(root)
+    if not root.exists():
+        return []
+    entries = sorted((entry for group in root.iterdir() if group.is_dir() for entry in group.iterdir()
+                      if not entry.name.endswith(".tmp")),
+                     key=lambda entry: entry.stat().st_mtime)
+    now = time.time()
+    sizes = {entry: folder_size(entry) if entry.is_dir() else entry.stat().st_size for entry in entries}
+    total = sum(sizes.values())
+
+    deleted = []
+    for entry in entries:  # oldest first
+        age = now - entry.stat().st_mtime
+        if age < min_age_hours * 3600:
+            break
+        if age > max_age_days * 86400 or total > max_bytes:
+            if entry.is_dir():
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink(missing_ok=True)
+            total -= sizes[entry]
+            deleted.append(entry)
+    return deleted
+
+
+class Checkpoints:
+    """Outputs of the stages that completed in a workspace, root/<stage>.pkl with the stage key and
+    the files it wrote (relative to base_dir, they stay where the stage wrote them)"""
+
+    def __init__(self, root, base_dir):
+        self.root = Path(root)
+        self.base_dir = Path(base_dir)
+
+    def save(self, name, key, outputs, files):
+        self.root.mkdir(parents=True, exist_ok=True)
+        checkpoint = {"key": key, "outputs": outputs,
+                      "files": [str(Path(file).relative_to(self.base_dir)) for file in files]}
+        tmp = self.root / f"{name}.pkl.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(self.root / f"{name}.pkl")
+
+    def load(self, name, key):
+        """Returns (outputs, files) saved for key, None when the stage has no checkpoint for key or its files are gone"""
+        path = self.root / f"{name}.pkl"
+        if not path.exists():
+            return None
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+        files = [self.base_dir / file for file in checkpoint["files"]]
+        if checkpoint["key"] != key or not all(file.is_file() for file in files):
+            return None
+        return checkpoint["outputs"], files
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
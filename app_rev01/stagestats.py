@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:  # optional, /proc is used on Linux without it
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+### THIS SCRIPT ##################################################
+### Per stage measurements of a pipeline run: wall/CPU time,    #
+### peak RSS, rows and entity counts in and out, bytes read and #
+### written. CPU time is the stage's own thread (plus finished  #
+### child processes); RSS is process wide, so stages and runs   #
+### executing at the same time show up in each other's peaks.   #
+##################################################################
+
+# RSS sampling interval (s)
+SAMPLE_INTERVAL = 0.02
+
+
+@dataclass
+class StageStats:
+    stage: str
+    started_s: float = None  # seconds after the run started (stages run concurrently)
+    cached: bool = False
+    resumed: bool = False  # restored from the checkpoint of a failed run
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float = None
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    counts: dict = field(default_factory=dict)
+
+
+def current_rss():
+    """Resident memory of this process in bytes, None when it can't be read"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def cpu_time():
+    """CPU time of the calling thread plus the finished child processes (PNG rendering pool)"""
+    total = time.thread_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total += children.ru_utime + children.ru_stime
+    return total
+
+
+class StageTimer:
+    """with StageTimer(stats): ... fills stats.wall_s, cpu_s and peak_rss_mb"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.peak = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._wall = time.perf_counter()
+        self._cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.wall_s = round(time.perf_counter() - self._wall, 4)
+        self.stats.cpu_s = round(cpu_time() - self._cpu, 4)
+        self._stop.set()
+        self._sampler.join()
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+        if self.peak is not None:
+            self.stats.peak_rss_mb = round(self.peak / 1e6, 1)
+        return False
+
+
+def count_rows(values):
+    """Rows of the DataFrames in values (dicts of tables are summed)"""
+    rows = 0
+    for value in values:
+        if isinstance(value, pd.DataFrame):
+            rows += len(value)
+        elif isinstance(value, dict):
+            rows += count_rows(value.values())
+    return rows
+
+
+def count_bytes(paths):
+    return sum(Path(p).stat().st_size for p in paths if Path(p).is_file())
+
+
+def stats_table(stats):
+    """One row per stage for display, scalar counts joined into one column"""
+    rows = []
+    for s in stats:
+        row = asdict(s)
+        counts = row.pop("counts")
+        row["counts"] = ", ".join(f"{k}={v}" for k, v in counts.items() if not isinstance(v, dict))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def save_stats(stats, output_path, **info):
+    """Writes {**info, stages: [...]} as JSON and returns the path"""
+    output_path = Path(output_path)
+    output_path.write_text(json.dumps({**info, "stages": [asdict(s) for s in stats]}, indent=2, default=str))
+    return output_path
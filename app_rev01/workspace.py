@@ -0,0 +1,95 @@
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+### THIS SCRIPT ##################################################
+### Run workspaces: every run reads and writes its own          #
+### uploads/ shared/ downloads/ folders so concurrent runs      #
+### don't overwrite each other's files.                         #
+##################################################################
+
+# Legacy layout next to the scripts, used when no workspace is given
+SCRIPT_DIR = Path(__file__).resolve().parent
+# Parent folder of the per-run workspaces
+WORKSPACES_DIR = SCRIPT_DIR / "workspaces"
+
+
+class Workspace:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def __repr__(self):
+        return f"Workspace({str(self.root)!r})"
+
+    @property
+    def name(self):
+        return self.root.name
+
+    @property
+    def uploads(self):
+        return self.root / "uploads"
+
+    @property
+    def shared(self):
+        return self.root / "shared"
+
+    @property
+    def drawingdata(self):
+        return self.shared / "drawingdata"
+
+    @property
+    def downloads(self):
+        return self.root / "downloads"
+
+    @property
+    def checkpoints(self):
+        return self.shared / ".checkpoints"
+
+    def create_folders(self):
+        for folder in (self.uploads, self.shared, self.drawingdata, self.downloads):
+            folder.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def add_uploads(self, input_paths):
+        """Copies input files into uploads/ (unless already there) and returns {key: workspace path}"""
+        self.uploads.mkdir(parents=True, exist_ok=True)
+        copied = {}
+        for key, path in input_paths.items():
+            path = Path(path)
+            target = self.uploads / path.name
+            if path.resolve() != target.resolve():
+                shutil.copy2(path, target)
+            copied[key] = target
+        return copied
+
+    @classmethod
+    def create(cls, parent=WORKSPACES_DIR):
+        """New empty workspace named <timestamp>_<id> under parent"""
+        name = f"{datetime.now():%Y%m%d-%H%M%S}_{uuid.uuid4().hex[:8]}"
+        return cls(Path(parent) / name).create_folders()
+
+    @classmethod
+    def default(cls):
+        return cls(SCRIPT_DIR)
+
+
+def cleanup_workspaces(parent=WORKSPACES_DIR, keep=20, min_age_hours=1, exclude=()):
+    """Deletes workspaces beyond the newest `keep` ones, sparing any modified within min_age_hours
+    and those listed in exclude. Returns the deleted folders."""
+    parent = Path(parent)
+    if not parent.exists():
+        return []
+    excluded = {Path(p).resolve() for p in exclude}
+    folders = sorted((p for p in parent.iterdir() if p.is_dir() and not p.name.startswith(".")),
+                     key=lambda p: p.stat().st_mtime, reverse=True)
+    cutoff = time.time() - min_age_hours * 3600
+
+    deleted = []
+    for folder in folders[keep:]:
+        if folder.resolve() in excluded or folder.stat().st_mtime > cutoff:
+            continue
+        shutil.rmtree(folder, ignore_errors=True)
+        deleted.append(folder)
+    return deleted